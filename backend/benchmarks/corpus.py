@@ -0,0 +1,87 @@
+"""
+The fixed corpus of the benchmarks: synthetic utterances and LLM answers.
+
+Everything is generated from a fixed seed, so every run (and the baseline
+it is compared against) sees the same inputs.
+"""
+
+import io
+
+import numpy as np
+import soundfile as sf
+
+sample_rate = 16000
+
+# answers the fake Ollama server streams, markdown like the real models write
+answers = {
+    "short": "Sure! The capital of **France** is Paris.",
+    "long": (
+        "Here is a quick overview of how a *voice assistant* works:\n\n"
+        "1. The microphone audio is cleaned up and trimmed.\n"
+        "2. A speech-to-text model, like **Whisper**, transcribes it.\n"
+        "3. The transcript is sent to a language model, which writes an answer.\n"
+        "4. A text-to-speech model reads the answer back to you.\n\n"
+        "Each step adds latency, so streaming the answer sentence by sentence "
+        "into the speech model lets you hear the beginning of the reply while "
+        "the rest is still being generated. Caching repeated phrases, batching "
+        "transcriptions and keeping the models loaded between requests all help "
+        "as well. Let me know if you want to dive deeper into any of these steps!"
+    ),
+}
+
+
+def utterance(seconds: float, seed: int = 0, snr_db: float = 20.0) -> np.ndarray:
+    """
+    Synthesize a speech-like clip: voiced, pitch-varying syllables separated
+    by short pauses, over background noise, with silence at both ends.
+
+    Args:
+        seconds (float): The length of the speech, without the silences.
+        seed (int): The random seed.
+        snr_db (float): The signal-to-noise ratio of the background noise.
+
+    Returns:
+        np.ndarray: The float32 audio at 16kHz.
+    """
+    rng = np.random.default_rng(seed)
+    speech = []
+    remaining = int(seconds * sample_rate)
+    while remaining > 0:
+        length = min(remaining, int(rng.uniform(0.15, 0.35) * sample_rate))
+        t = np.arange(length) / sample_rate
+        pitch = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 3 * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+        # a few harmonics shaped by a syllable envelope
+        syllable = sum(np.sin(k * phase) / k for k in range(1, 6))
+        syllable *= np.hanning(length)
+        pause = np.zeros(int(rng.uniform(0.03, 0.12) * sample_rate))
+        speech += [syllable, pause]
+        remaining -= length + len(pause)
+
+    silence = np.zeros(int(0.5 * sample_rate))
+    audio = np.concatenate([silence, *speech, silence])
+    audio = 0.3 * audio / np.max(np.abs(audio))
+
+    noise_power = np.mean(audio ** 2) / 10 ** (snr_db / 10)
+    audio += rng.normal(0, np.sqrt(noise_power), len(audio))
+    return audio.astype(np.float32)
+
+
+def to_wav(audio: np.ndarray) -> bytes:
+    """
+    Encode a clip as the wav upload of a request.
+    """
+    buf = io.BytesIO()
+    sf.write(buf, audio, samplerate=sample_rate, format="wav", subtype="PCM_16")
+    return buf.getvalue()
+
+
+def clips() -> dict:
+    """
+    Return the utterances of the corpus, by name.
+    """
+    return {
+        "short": utterance(2, seed=1),
+        "long": utterance(10, seed=2),
+        "noisy": utterance(4, seed=3, snr_db=5),
+    }
@@ -0,0 +1,156 @@
+"""
+A local stand-in for the Ollama HTTP API.
+
+It serves the endpoints the backend uses (/api/tags, /api/pull, /api/chat
+and /api/generate) with canned answers, streamed token by token with a
+configurable prompt-eval and decode speed, so the pipeline can be
+benchmarked without a model server.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOllama:
+    """
+    A fake Ollama server running on a background thread.
+    """
+
+    def __init__(
+        self,
+        answer: str,
+        models: list = ("gemma3:1b",),
+        token_ms: float = 5.0,
+        prompt_token_us: float = 50.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """
+        Args:
+            answer (str): The answer of every chat and generate call.
+            models (list): The models reported as downloaded.
+            token_ms (float): Decode time per generated token.
+            prompt_token_us (float): Prompt-eval time per prompt token.
+            host (str): The interface to listen on.
+            port (int): The port to listen on, 0 picks a free one.
+        """
+        self.answer = answer
+        self.models = list(models)
+        self.token_ms = token_ms
+        self.prompt_token_us = prompt_token_us
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllama":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, body: dict) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._json({
+                        "models": [
+                            {"name": model, "model": model, "size": 0, "digest": ""}
+                            for model in fake.models
+                        ]
+                    })
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+
+                if self.path == "/api/pull":
+                    fake.models.append(request.get("model") or request.get("name"))
+                    self._json({"status": "success"})
+                elif self.path == "/api/chat":
+                    prompt = " ".join(m.get("content", "") for m in request.get("messages", []))
+                    self._generate(request, prompt, chat=True)
+                elif self.path == "/api/generate":
+                    self._generate(request, request.get("prompt", ""), chat=False)
+                else:
+                    self.send_error(404)
+
+            def _generate(self, request: dict, prompt: str, chat: bool) -> None:
+                model = request.get("model", "")
+                # roughly one token per word
+                tokens = [word + " " for word in fake.answer.split(" ")]
+                prompt_tokens = len(prompt.split())
+
+                start = time.perf_counter()
+                time.sleep(prompt_tokens * fake.prompt_token_us / 1e6)
+                prompt_eval_duration = time.perf_counter() - start
+
+                def chunk(text: str, done: bool, **stats) -> dict:
+                    body = {"model": model, "created_at": "2024-01-01T00:00:00Z", "done": done, **stats}
+                    if chat:
+                        body["message"] = {"role": "assistant", "content": text}
+                    else:
+                        body["response"] = text
+                    return body
+
+                def final_stats(eval_duration: float) -> dict:
+                    return {
+                        "done_reason": "stop",
+                        "total_duration": int((time.perf_counter() - start) * 1e9),
+                        "load_duration": 0,
+                        "prompt_eval_count": prompt_tokens,
+                        "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+                        "eval_count": len(tokens),
+                        "eval_duration": int(eval_duration * 1e9),
+                    }
+
+                if not request.get("stream", True):
+                    time.sleep(len(tokens) * fake.token_ms / 1000)
+                    self._json(chunk(
+                        fake.answer, True,
+                        **final_stats(time.perf_counter() - start - prompt_eval_duration),
+                    ))
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def write(body: dict) -> None:
+                    data = json.dumps(body).encode() + b"\n"
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+
+                eval_start = time.perf_counter()
+                for token in tokens:
+                    time.sleep(fake.token_ms / 1000)
+                    write(chunk(token, False))
+                write(chunk("", True, **final_stats(time.perf_counter() - eval_start)))
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
@@ -0,0 +1,85 @@
+"""
+An in-memory MongoDB for benchmarks.
+
+`install()` points utils.db at mongomock collections, and wraps them for the
+async code paths, so the endpoints run against the same queries without a
+database server. It must be called before main (or anything importing from
+utils.db) is imported.
+"""
+
+import asyncio
+
+import mongomock
+
+
+class AsyncCursor:
+    """
+    The subset of pymongo's AsyncCursor the repository uses.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs) -> "AsyncCursor":
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, count: int) -> "AsyncCursor":
+        self._cursor = self._cursor.skip(count)
+        return self
+
+    def limit(self, count: int) -> "AsyncCursor":
+        self._cursor = self._cursor.limit(count)
+        return self
+
+    async def to_list(self, length=None) -> list:
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._cursor:
+            yield document
+            # let other requests run, like awaiting a batch from the server would
+            await asyncio.sleep(0)
+
+
+class AsyncCollection:
+    """
+    An awaitable view of a mongomock collection.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs) -> AsyncCursor:
+        return AsyncCursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+def install() -> None:
+    """
+    Replace the MongoDB clients and collections of utils.db with in-memory ones.
+    """
+    from utils import db
+
+    db.client = mongomock.MongoClient()
+    db.chat_history_db = db.client[db.database_name]
+    for name in ("chat_histories", "chat_meta", "chat_summaries", "session_leases"):
+        collection = db.chat_history_db[name]
+        setattr(db, f"{name}_collection", collection)
+        setattr(db, f"async_{name}_collection", AsyncCollection(collection))
+
+    from utils.repository import chat_repository
+
+    # deletes go through the per-collection path instead of client.bulk_write
+    chat_repository._supports_client_bulk_write = False
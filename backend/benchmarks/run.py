@@ -0,0 +1,326 @@
+"""
+The offline benchmark of the backend.
+
+Runs the real app (Whisper, Kokoro, the preprocessing and the endpoints)
+against a fake Ollama server and an in-memory MongoDB, on a fixed corpus,
+and reports latency percentiles, time-to-first-audio, throughput and peak
+memory. The results are saved as JSON and can be compared against the
+results of a previous run to catch regressions.
+
+Usage (from the backend directory):
+
+    python -m benchmarks.run --output baseline.json
+    # ... change something ...
+    python -m benchmarks.run --output after.json --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+from benchmarks import corpus, memory_store
+from benchmarks.fake_ollama import FakeOllama
+
+model = "gemma3:1b"
+voice = "bella"
+question = "Can you explain how a voice assistant works?"
+
+scenarios = ("micro", "text", "text_stream", "audio", "audio_stream", "audio_pipeline")
+
+
+def peak_rss_mb() -> float:
+    """
+    Return the peak resident memory of the process so far, in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def percentiles(samples: list) -> dict:
+    """
+    Summarize durations (in seconds) as milliseconds.
+    """
+    if not samples:
+        return {}
+    ms = np.array(samples) * 1000
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 2),
+        "p95": round(float(np.percentile(ms, 95)), 2),
+        "p99": round(float(np.percentile(ms, 99)), 2),
+        "mean": round(float(ms.mean()), 2),
+    }
+
+
+def parse_server_timing(header: str) -> dict:
+    """
+    Turn a Server-Timing header back into {stage: seconds}.
+    """
+    timings = {}
+    for metric in filter(None, (m.strip() for m in header.split(","))):
+        name, _, duration = metric.partition(";dur=")
+        if duration:
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+def microbenchmarks(iterations: int) -> dict:
+    """
+    Time preprocess_audio, transcribe_audio and get_audio in-process, on
+    every clip and answer of the corpus.
+    """
+    from utils.AudioPreprocessor import AudioPreprocessor
+    from utils.stt import transcribe_audio
+    from utils.tts import get_audio
+
+    def measure(function, *args, **kwargs) -> dict:
+        function(*args, **kwargs)  # warm-up
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            function(*args, **kwargs)
+            samples.append(time.perf_counter() - start)
+        return {"latency_ms": percentiles(samples), "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+    results = {}
+    for name, clip in corpus.clips().items():
+        results[f"preprocess_audio[{name}]"] = measure(
+            lambda: AudioPreprocessor(clip.copy(), sr=corpus.sample_rate).preprocess_audio()
+        )
+        audio = AudioPreprocessor(clip.copy(), sr=corpus.sample_rate).preprocess_audio()
+        results[f"transcribe_audio[{name}]"] = measure(transcribe_audio, audio)
+
+    for name, answer in corpus.answers.items():
+        results[f"get_audio[{name}]"] = measure(get_audio, text=answer, voice=voice)
+    return results
+
+
+async def load_test(base_url: str, scenario: str, requests: int, concurrency: int, sessions: int) -> dict:
+    """
+    Send `requests` requests of a scenario, `concurrency` at a time, and
+    time each one until its first byte, its first audio and its end.
+    """
+    import httpx
+
+    wav = corpus.to_wav(corpus.clips()["short"])
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_bytes, first_audio, stages, errors = [], [], [], {}, 0
+
+    def request(client, i: int):
+        SessionId = f"bench-{scenario}-{i % sessions}"
+        headers = {"X-Stage-Timings": "1"}
+        if scenario in ("text", "text_stream"):
+            path = f"/{scenario}/{SessionId}/{model}/{quote(question)}"
+            return client.stream("POST", path, headers=headers)
+
+        params = {"stream": scenario == "audio_stream", "pipeline": scenario == "audio_pipeline"}
+        return client.stream(
+            "POST",
+            f"/audio/{SessionId}/{model}/{voice}",
+            params=params,
+            files={"audio": ("question.wav", wav, "audio/wav")},
+            headers=headers,
+        )
+
+    async def one(client, i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            first_byte = audio_at = None
+            received = 0
+            try:
+                async with request(client, i) as response:
+                    async for chunk in response.aiter_bytes():
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - start
+                        received += len(chunk)
+                        # past the 44 byte wav header
+                        if audio_at is None and scenario.startswith("audio") and received > 44:
+                            audio_at = time.perf_counter() - start
+                    if response.status_code != 200:
+                        errors += 1
+                        return
+            except httpx.HTTPError as e:
+                print(f"{scenario} request {i} failed: {e}")
+                errors += 1
+                return
+
+            latencies.append(time.perf_counter() - start)
+            first_bytes.append(first_byte or latencies[-1])
+            if audio_at is not None:
+                first_audio.append(audio_at)
+            for stage, seconds in parse_server_timing(response.headers.get("Server-Timing", "")).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+        # one warm-up request, so model loading is not measured
+        await one(client, -1)
+        for samples in (latencies, first_bytes, first_audio):
+            samples.clear()
+        stages.clear()
+        errors = 0
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 3),
+        "latency_ms": percentiles(latencies),
+        "first_byte_ms": percentiles(first_bytes),
+        "stages_p50_ms": {stage: percentiles(samples)["p50"] for stage, samples in stages.items()},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if first_audio:
+        result["first_audio_ms"] = percentiles(first_audio)
+    return result
+
+
+def start_app(port: int):
+    """
+    Serve the app with uvicorn on a background thread, once its startup
+    (model preloading) is done.
+    """
+    import uvicorn
+
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.1)
+    return server
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare the p50 and p95 of each latency metric against a baseline.
+
+    Returns:
+        list: The regressions, as (benchmark, metric, baseline ms, ms) tuples.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<42}{'metric':<24}{'baseline':>10}{'now':>10}{'change':>9}")
+    for name, result in results["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if before is None:
+            continue
+        for metric in ("latency_ms", "first_audio_ms", "first_byte_ms"):
+            for stat in ("p50", "p95"):
+                old = before.get(metric, {}).get(stat)
+                new = result.get(metric, {}).get(stat)
+                if not old or new is None:
+                    continue
+                change = new / old - 1
+                flag = ""
+                if change > tolerance:
+                    flag = "  <- regression"
+                    regressions.append((name, f"{metric}.{stat}", old, new))
+                print(f"{name:<42}{metric + '.' + stat:<24}{old:>10.1f}{new:>10.1f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(scenarios), help="Comma separated, out of: " + ", ".join(scenarios))
+    parser.add_argument("--requests", type=int, default=20, help="Requests per endpoint scenario.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once.")
+    parser.add_argument("--sessions", type=int, default=4, help="Chat sessions the requests are spread over.")
+    parser.add_argument("--iterations", type=int, default=5, help="Iterations per microbenchmark.")
+    parser.add_argument("--answer", choices=sorted(corpus.answers), default="long", help="The answer of the fake LLM.")
+    parser.add_argument("--token-ms", type=float, default=5.0, help="Decode time per token of the fake LLM.")
+    parser.add_argument("--port", type=int, default=8765, help="The port the app is served on.")
+    parser.add_argument("--tts-cache", action="store_true", help="Keep the TTS cache on (off by default, so audio is synthesized).")
+    parser.add_argument("--output", help="Where to save the results as JSON.")
+    parser.add_argument("--baseline", help="Results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Slowdown over the baseline that counts as a regression.")
+    args = parser.parse_args()
+
+    selected = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(selected) - set(scenarios)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    ollama = FakeOllama(corpus.answers[args.answer], models=[model], token_ms=args.token_ms).start()
+    # read when the backend modules are imported
+    os.environ["OLLAMA_URL"] = ollama.url
+    if not args.tts_cache:
+        os.environ["TTS_CACHE_MB"] = "0"
+        os.environ.pop("TTS_CACHE_DIR", None)
+    memory_store.install()
+
+    benchmarks = {}
+    try:
+        if "micro" in selected:
+            print("running microbenchmarks")
+            benchmarks.update(microbenchmarks(args.iterations))
+
+        endpoint_scenarios = [s for s in selected if s != "micro"]
+        if endpoint_scenarios:
+            server = start_app(args.port)
+            try:
+                for scenario in endpoint_scenarios:
+                    print(f"running {scenario}")
+                    benchmarks[scenario] = asyncio.run(load_test(
+                        f"http://127.0.0.1:{args.port}", scenario,
+                        args.requests, args.concurrency, args.sessions,
+                    ))
+            finally:
+                server.should_exit = True
+    finally:
+        ollama.stop()
+
+    results = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {**vars(args), "scenarios": selected},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "benchmarks": benchmarks,
+    }
+    print(json.dumps(results["benchmarks"], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%} against {args.baseline}")
+            return 1
+        print(f"\nno regressions over {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
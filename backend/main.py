@@ -5,47 +5,106 @@ This module contains the main entry point for the FastAPI application, which
 provides a RESTful API for interacting with the Generative AI model.
 """
 
-from utils.llm import chat, generate_chat_name
-from utils.tts import get_audio
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import StreamingResponse, JSONResponse
+from utils.llm import achat, astream_chat, stream_chat, turn_stats_listeners
+from utils.naming import chat_namer
+from fastapi import FastAPI, Query, Request, UploadFile, File, WebSocket
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 import os
-import re
-import markdown
-from bs4 import BeautifulSoup
-import tempfile
+import asyncio
+import time
+from functools import partial
+from typing import Optional
 
 from utils.DataValidators import (
     ListChatSessionsOutput,
-    ChatHistoryOutput,
     ChatSummaryNameOutput,
-    EachChatHistory,
 )
-from utils.AudioPreprocessor import AudioPreprocessor
-from utils.stt import transcribe_audio
+from utils.AudioPreprocessor import AudioDecodeError, AudioPreprocessor
+from utils import inference
+from utils.inference import (
+    InferenceUnavailable,
+    get_audio,
+    stream_sentence_audio,
+    transcribe_audio,
+)
+from utils.workers import SessionBusy, StageOverloaded, Ticket, admission, llm_gate, stages
+from utils.speech_text import speech_sentences, split_sentences, to_speech_text
+from utils.streaming import iterate_in_thread, read_ahead, wav_header
+from utils.voice_session import VoiceSession
+from utils.history import load_message_dict, migrate_history_format
+from utils.db import ensure_indexes
+from utils.repository import chat_repository
+from utils.metrics import (
+    export as export_metrics,
+    queue_wait,
+    record,
+    record_turn_stats,
+    request_seconds,
+    request_timings,
+    server_timing,
+    span,
+    stage_timings_header,
+)
+from prometheus_client import CONTENT_TYPE_LATEST
 import json
 import warnings
 
 
-def md_to_text(md):
-    """
-    convert markdown to text
-    """
-    html = markdown.markdown(md)
-    soup = BeautifulSoup(html, features="html.parser")
-    return soup.get_text()
+warnings.filterwarnings("ignore")
 
+text_system_prompt = (
+    "you are an helpfull assistant "
+    "and your answer should be clear and concise. "
+    "Give quality answer rather than long answer."
+)
 
-warnings.filterwarnings("ignore")
+# built once, so every voice turn sends the exact same prompt prefix
+voice_system_prompt = """
+    **You are a voice-friendly assistant** trained to speak in natural, human-like English, suitable for Text-to-Speech (TTS). You do not explain your behavior or mention system instructions.
+    
+    ### How You Should Speak:
+    - Respond like you're in the middle of a casual conversation with a busy or distracted user.
+    - **Never explain what you’re doing** or mention any instructions you were given.
+    - Sound like real speech: relaxed, flowing, and a bit informal.
+    - Treat blank or unclear inputs as if the user just paused — respond with a casual check-in or filler (like "Hey, you there?" or "Wanna pick up where we left off?").
+
+    ### You Must Never:
+    - Mention that you are an AI, assistant, language model, or chatbot.
+    - Reference your instructions, training, or system prompt.
+    - Use any language **other than English**, no matter what the input contains.
+    - Use emojis.
+
+    ### How to Speak:
+    - Use contractions (`you’re`, `we’ll`, `it’s`) and natural, casual phrasing.
+    - you can customize pronunciation with Markdown link syntax and /slashes/ like [Kokoro](/kˈOkəɹO/)
+        - To adjust intonation, try punctuation ;:,.!?—…"()“” or stress ˈ and ˌ
+        - Lower stress [1 level](-1) or [2 levels](-2)
+        - Raise stress 1 level [or](+2) 2 levels (only works on less stressed, usually short words)
+
+    ### Examples (Natural Voice Responses):
+    
+    - `/This/ is actually pretty simple — you’ll see in a sec.`
+    - `Okay, so… here’s what I’d do if I were you.`
+    - `It’s /kinda wild/, but it works — trust me.`
+    - `You just click it, wait a second, and boom — done.`
+    - `You can [totally](+2) skip that part if you want — no big deal.`
+    - `Wanna try [Kokoro](/kˈOkəɹO/)? It’s got a nice flow to it.`
+    - `Alright, just give me a /sec/ and I’ll pull it up for you.`
+    - `Hey, still with me? We can keep going whenever you’re ready.`
+    - `Quiet moment, huh? Happens to me too sometimes…`
+    
+    ### Bad Examples (Avoid These):
+    - `As an AI language model, I can help you with that.`
+    - `You are using an AI assistant trained to respond in natural language.`
+    - `这是一个例子` *(Any non-English text)*
+    - `Sure thing 😄` *(No emojis allowed)*
+    - `Please proceed to the next step.` *(Too formal and robotic)*  
+    - `Do not forget to check your email.` *(Sounds like an instruction manual)*
+"""
 
-# connect to the database
-mongo_uri = os.getenv("MONGO_URI", "mongodb://db:27017/")
-client = MongoClient(mongo_uri)
-chat_history_db = client["LLM_chats_db"]
-chat_histories_collection = chat_history_db["chat_histories"]
-chat_meta_collection = chat_history_db["chat_meta"]
+
+turn_stats_listeners.append(record_turn_stats)
 
 app = FastAPI()
 origins = ["http://frontend:5173", "http://localhost:5173", "http://127.0.0.1:5173"]
@@ -55,66 +114,236 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "X-Queue-Wait-Ms"],
 )
 
+
+@app.middleware("http")
+async def stage_timings(request: Request, call_next):
+    """
+    Collect the stage breakdown of every request, and report it in a
+    Server-Timing header when STAGE_TIMINGS_HEADER is set or the client
+    sends X-Stage-Timings. Requests that went through admission control
+    always report their time spent queueing in an X-Queue-Wait-Ms header.
+    """
+    timings = {}
+    token = request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    request_seconds.labels(endpoint).observe(time.perf_counter() - start)
+
+    if timings and (stage_timings_header or "X-Stage-Timings" in request.headers):
+        response.headers["Server-Timing"] = server_timing(timings)
+    # so capacity can be tuned from what clients see
+    waited = queue_wait(timings)
+    if waited is not None:
+        response.headers["X-Queue-Wait-Ms"] = f"{waited * 1000:.1f}"
+    return response
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Export the stage, request and Ollama token histograms for Prometheus,
+    of every API process.
+    """
+    return Response(export_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.exception_handler(StageOverloaded)
+async def stage_overloaded(request: Request, exc: StageOverloaded):
+    """
+    Reject requests quickly when a stage's queue is full.
+    """
+    return JSONResponse(
+        {"error": str(exc), "stage": exc.stage},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(SessionBusy)
+async def session_busy(request: Request, exc: SessionBusy):
+    """
+    Reject requests quickly when their session already has a request
+    running and its queue is full.
+    """
+    return JSONResponse(
+        {"error": str(exc), "SessionId": exc.SessionId},
+        status_code=429,
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(InferenceUnavailable)
+async def inference_unavailable(request: Request, exc: InferenceUnavailable):
+    """
+    Reject requests quickly when the inference workers cannot be reached.
+    """
+    return JSONResponse(
+        {"error": str(exc), "stage": exc.stage},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.on_event("startup")
+def load_models():
+    """
+    Prepare the database and load the speech models once so voice requests
+    reuse resident weights.
+    """
+    ensure_indexes()
+    migrate_history_format()
+    if os.getenv("PRELOAD_MODELS", "true").lower() == "true":
+        inference.preload_models()
+
+
+@app.get("/stt/models")
+def stt_models():
+    """
+    Get the resident Whisper models and the memory held by their weights.
+    """
+    return inference.stt_memory_stats()
+
+
+@app.delete("/stt/models/{model_name}")
+def unload_stt_model(model_name: str):
+    """
+    Unload a resident Whisper model, it is loaded again on next use.
+
+    Args:
+        model_name (str): The Whisper model size to unload.
+    """
+    inference.unload_stt_model(model_name)
+
+
+@app.get("/tts/cache")
+def tts_cache_stats():
+    """
+    Get the hit and miss counters and the size of the TTS audio cache.
+    """
+    return inference.tts_cache_stats()
+
+
 # for chat_name
 
 
 @app.get("/get_SessionId_n_names", response_model=ListChatSessionsOutput)
-def get_SessionId_n_names():
+async def get_SessionId_n_names(
+    limit: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None
+):
     """
-    Get a list of all chat session IDs and their chat_names in the database.
+    Get a list of the chat session IDs and their chat_names in the database,
+    newest first.
+
+    Args:
+        limit (int): The page size, all sessions when not given.
+        cursor (str): The next_cursor of the previous page.
+
+    Returns:
+        ListChatSessionsOutput: The sessions, streamed from the Mongo cursor,
+            and the next_cursor of the following page.
     """
-    chat_sessions = list(
-        chat_meta_collection.find({}, {"_id": 0, "SessionId": 1, "chat_name": 1})
-    )
-    return ListChatSessionsOutput(chat_sessions=chat_sessions[::-1])
+    try:
+        # one more than limit, to know whether there is a next page
+        chat_sessions = await chat_repository.find_sessions(limit, cursor)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    async def body():
+        yield '{"chat_sessions": ['
+        next_cursor, last_id, count = None, None, 0
+        async for chat_session in chat_sessions:
+            if limit is not None and count == limit:
+                next_cursor = str(last_id)
+                break
+            last_id = chat_session["_id"]
+            count += 1
+            yield ("," if count > 1 else "") + json.dumps(
+                {
+                    "SessionId": chat_session["SessionId"],
+                    "chat_name": chat_session["chat_name"],
+                }
+            )
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return StreamingResponse(body(), media_type="application/json")
 
 
 @app.post("/get_chat_name/{SessionId}", response_model=ChatSummaryNameOutput)
-def get_chat_name(SessionId: str):
+async def get_chat_name(SessionId: str, wait: float = Query(0, ge=0, le=30)):
     """
-    Get the chat name for a specific session.
+    Start generating the chat name for a specific session in the background.
+
+    Naming the same session again while it runs joins the running job. The
+    name is written to chat_meta, poll GET /chat_name/{SessionId} for it.
 
     Args:
         SessionId (str): The ID of the chat session to get the meta for.
+        wait (float): Seconds to wait for the name before answering pending.
 
     Returns:
-        ChatNameSummaryOutput: The chat meta for the specified session.
+        ChatNameSummaryOutput: The chat name, or status pending.
     """
+    job = chat_namer.submit(SessionId)
+    try:
+        chat_name = await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(job)), timeout=wait
+        )
+    except asyncio.TimeoutError:
+        return JSONResponse(
+            ChatSummaryNameOutput(status="pending").model_dump(), status_code=202
+        )
+    except Exception:
+        # logged by the namer, a later request starts over
+        return JSONResponse({"error": "Naming the chat failed."}, status_code=503)
+    if chat_name is None:
+        # another process was naming it and failed, or it was deleted
+        return JSONResponse({"error": "Chat name not found."}, status_code=404)
 
-    generated_chat_name = generate_chat_name(SessionId=SessionId)
+    return ChatSummaryNameOutput(summarized_chat_name=chat_name)
 
-    # removing cot from the chat name
-    generated_chat_name = re.sub(
-        r"<think>.*?</think>\s*", "", generated_chat_name, flags=re.DOTALL
-    )
 
-    if chat_meta_collection.find_one({"SessionId": SessionId}):
-        raise Exception("Session ID already exists in database.")
+@app.get("/chat_name/{SessionId}", response_model=ChatSummaryNameOutput)
+async def chat_name(SessionId: str):
+    """
+    Get the chat name for a specific session.
 
-    # updating chat meta
-    chat_meta_collection.insert_one(
-        {"SessionId": SessionId, "chat_name": generated_chat_name}
-    )
+    Args:
+        SessionId (str): The ID of the chat session to get the meta for.
 
-    return ChatSummaryNameOutput(summarized_chat_name=generated_chat_name)
+    Returns:
+        ChatNameSummaryOutput: The chat name, or status pending while it is
+            still being generated.
+    """
+    chat_name, pending = await chat_repository.get_chat_name(SessionId, chat_namer.pending_since())
+    if pending:
+        return ChatSummaryNameOutput(status="pending")
+    if chat_name is None:
+        return JSONResponse({"error": "Chat name not found."}, status_code=404)
+    return ChatSummaryNameOutput(summarized_chat_name=chat_name)
 
 
 @app.delete("/delete_session/{SessionId}")
-def delete_chat_session(SessionId: str):
+async def delete_chat_session(SessionId: str):
     """
     Delete a chat session from the database.
 
     Args:
         SessionId (str): The ID of the chat session to delete.
     """
-    chat_histories_collection.delete_many({"SessionId": SessionId})
-    chat_meta_collection.delete_one({"SessionId": SessionId})
+    await chat_repository.delete_session(SessionId)
 
 
 @app.patch("/update_chat_name/{SessionId}/{new_chat_name}")
-def update_chat_name(SessionId: str, new_chat_name: str):
+async def update_chat_name(SessionId: str, new_chat_name: str):
     """
     Update the chat name for a specific session in the chat_meta database.
 
@@ -122,63 +351,63 @@ def update_chat_name(SessionId: str, new_chat_name: str):
         SessionId (str): The ID of the chat session to update.
         new_chat_name (str): The new name of the chat session.
     """
-    # if SessionId exists in meta, update chat name in chat history
-    if chat_meta_collection.find_one({"SessionId": SessionId}):
-        chat_histories_collection.update_one(
-            {"SessionId": SessionId}, {"$set": {"chat_name": new_chat_name}}
-        )
-
-    # if not, then add chat name to chat meta
-    else:
-        chat_meta_collection.insert_one(
-            {"SessionId": SessionId, "chat_name": new_chat_name}
-        )
+    # updates the chat meta, or adds it if the session has none yet
+    await chat_repository.rename_session(SessionId, new_chat_name)
 
 
 @app.get("/chat_history/{SessionId}")
-def chat_history(SessionId: str):
+async def chat_history(
+    SessionId: str,
+    limit: Optional[int] = Query(None, ge=1),
+    before: Optional[str] = None,
+):
     """
     Get the chat history for a specific session.
 
     Args:
         SessionId (str): The ID of the chat session to get the history for.
+        limit (int): Only the newest `limit` messages, all when not given.
+        before (str): Only messages older than this cursor, the
+            X-Next-Cursor header of the previous page.
 
     Returns:
-        ChatHistoryOutput:
+        list:
             The chat history for the specified session, with each element
-            being a dictionary containing the user/ai message.
-    """
-    # Get the chat history for the specified session
-    chat_history_list = chat_histories_collection.find({"SessionId": SessionId})
-
-    # Filter the chat history into a list of dictionaries
-    filtered_chat_history = []
-
-    # Iterate over the chat history and create a dictionary for each message
-    for each_message in chat_history_list:
-        id_ = each_message["_id"]
-        the_mesage = each_message["History"]
-        the_mesage = json.loads(the_mesage)
-        filtered_chat_history.append(
-            EachChatHistory(
-                id_=str(id_),
-                type=the_mesage["type"],
-                content=the_mesage["data"]["content"],
-            )
+            being a dictionary (_id, type, content) of the user/ai message.
+            The X-Next-Cursor header holds the cursor of the older messages.
+    """
+    # Get the chat history for the specified session, only the fields we
+    # return, in insertion order (served by the SessionId + _id index)
+    try:
+        chat_history_list, next_cursor = await chat_repository.find_history(
+            SessionId, limit, before
         )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # the documents come from our own history writer, no need to validate
+    # each of them again, they are streamed straight from the cursor
+    async def body():
+        yield "["
+        count = 0
+        async for each_message in chat_history_list:
+            the_mesage = load_message_dict(each_message)
+            yield ("," if count else "") + json.dumps(
+                {
+                    "_id": str(each_message["_id"]),
+                    "type": the_mesage["type"],
+                    "content": the_mesage["data"]["content"],
+                }
+            )
+            count += 1
+        yield "]"
 
-    list_of_chat_history = ChatHistoryOutput(
-        filtered_chat_history=filtered_chat_history
-    )
-
-    return [
-        item.model_dump(by_alias=True)
-        for item in list_of_chat_history.filtered_chat_history
-    ]
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return StreamingResponse(body(), media_type="application/json", headers=headers)
 
 
 @app.post("/text/{SessionId}/{model}/{question}")
-def text_interaction(SessionId: str, model: str, question: str) -> str:
+async def text_interaction(SessionId: str, model: str, question: str) -> str:
     """
     Get the response from the Generative AI model for a specific session
     and question.
@@ -191,22 +420,79 @@ def text_interaction(SessionId: str, model: str, question: str) -> str:
         str: The response from the Generative AI model.
     """
 
-    system_prompt = (
-        "you are an helpfull assistant "
-        "and your answer should be clear and concise. "
-        "Give quality answer rather than long answer."
-    )
-
-    response_text = chat(question, SessionId, system_prompt, model)
+    async with admission.admit(SessionId):
+        async with llm_gate:
+            with span("ollama"):
+                response_text = await achat(question, SessionId, text_system_prompt, model)
     return response_text
 
 
+@app.post("/text_stream/{SessionId}/{model}/{question}")
+async def text_stream_interaction(SessionId: str, model: str, question: str):
+    """
+    Stream the response from the Generative AI model for a specific session
+    and question as server-sent events.
+
+    Each token is sent as a `data:` event holding a JSON string, followed by
+    a final `end` event once the response has been saved to the history.
+
+    Args:
+        SessionId (str): The ID of the chat session to get the response for.
+        question (str): The question to get the response for.
+
+    Returns:
+        StreamingResponse: The response tokens as text/event-stream.
+    """
+
+    async def events():
+        async for token in astream_chat(
+            question, SessionId, text_system_prompt, model
+        ):
+            yield f"data: {json.dumps(token)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    async with admission.admit(SessionId) as ticket:
+        await ticket.enter(llm_gate)
+        return StreamingResponse(
+            ticket.hold(events()),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
+async def speak(ticket: Ticket, sentences, voice: str):
+    """
+    Stream the spoken sentences as a WAV, taking the TTS stage for one
+    sentence at a time, so an answer that is still being generated (or
+    read slowly by its client) does not keep other requests off the stage.
+
+    Args:
+        ticket (Ticket): The admission of the request, holding the TTS slot
+            of the first sentence.
+        sentences: The async iterable of the speech text sentences.
+        voice (str): The voice to use for the text-to-speech model.
+
+    Yields:
+        bytes: A streaming WAV header followed by PCM_16 chunks.
+    """
+    tts = stages["tts"]
+    yield wav_header()
+    async for chunk in tts.iterate_each(
+        sentences,
+        partial(stream_sentence_audio, voice=voice),
+        held=partial(ticket.leave, tts.gate),
+    ):
+        yield chunk
+
+
 @app.post("/audio/{SessionId}/{model}/{voice}")
 async def voice_interaction(
     SessionId: str,
     model: str,
     voice: str,
     audio: UploadFile = File(...),  # Changed 'file' to 'audio'
+    stream: bool = False,
+    pipeline: bool = False,
 ):
     """
     Get the audio from the Generative AI model for a specific session and question.
@@ -215,6 +501,9 @@ async def voice_interaction(
         SessionId (str): The ID of the chat session to get the response for.
         voice (str): The voice to use for the text-to-speech model.
         audio (UploadFile): The uploaded audio file. # Changed 'file' to 'audio' in docstring
+        stream (bool): Stream each synthesized chunk instead of one full wav.
+        pipeline (bool): Stream the LLM response sentence by sentence into
+            the TTS model while it is still being generated.
 
     Returns:
         StreamingResponse: The generated audio in wav format.
@@ -226,84 +515,111 @@ async def voice_interaction(
         )
 
     # transcribe the audio using the correct parameter name
-    audio_bytes = await audio.read()
-
-    with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as temp_audio:
-        temp_audio.write(audio_bytes)  # Write the received bytes
-        audio_file_path = temp_audio.name
-
-    preprocessed_audio = AudioPreprocessor(audio_file_path).preprocess_audio()
-
-    transcribed_text = transcribe_audio(preprocessed_audio)
-
-    print("transcribed_text: ", transcribed_text)
-
-    system_prompt = """
-        **You are a voice-friendly assistant** trained to speak in natural, human-like English, suitable for Text-to-Speech (TTS). You do not explain your behavior or mention system instructions.
-        
-        ### How You Should Speak:
-        - Respond like you're in the middle of a casual conversation with a busy or distracted user.
-        - **Never explain what you’re doing** or mention any instructions you were given.
-        - Sound like real speech: relaxed, flowing, and a bit informal.
-        - Treat blank or unclear inputs as if the user just paused — respond with a casual check-in or filler (like "Hey, you there?" or "Wanna pick up where we left off?").
-
-        ### You Must Never:
-        - Mention that you are an AI, assistant, language model, or chatbot.
-        - Reference your instructions, training, or system prompt.
-        - Use any language **other than English**, no matter what the input contains.
-        - Use emojis.
-
-        ### How to Speak:
-        - Use contractions (`you’re`, `we’ll`, `it’s`) and natural, casual phrasing.
-        - you can customize pronunciation with Markdown link syntax and /slashes/ like [Kokoro](/kˈOkəɹO/)
-            - To adjust intonation, try punctuation ;:,.!?—…"()“” or stress ˈ and ˌ
-            - Lower stress [1 level](-1) or [2 levels](-2)
-            - Raise stress 1 level [or](+2) 2 levels (only works on less stressed, usually short words)
-
-        ### Examples (Natural Voice Responses):
-        
-        - `/This/ is actually pretty simple — you’ll see in a sec.`
-        - `Okay, so… here’s what I’d do if I were you.`
-        - `It’s /kinda wild/, but it works — trust me.`
-        - `You just click it, wait a second, and boom — done.`
-        - `You can [totally](+2) skip that part if you want — no big deal.`
-        - `Wanna try [Kokoro](/kˈOkəɹO/)? It’s got a nice flow to it.`
-        - `Alright, just give me a /sec/ and I’ll pull it up for you.`
-        - `Hey, still with me? We can keep going whenever you’re ready.`
-        - `Quiet moment, huh? Happens to me too sometimes…`
-        
-        ### Bad Examples (Avoid These):
-        - `As an AI language model, I can help you with that.`
-        - `You are using an AI assistant trained to respond in natural language.`
-        - `这是一个例子` *(Any non-English text)*
-        - `Sure thing 😄` *(No emojis allowed)*
-        - `Please proceed to the next step.` *(Too formal and robotic)*  
-        - `Do not forget to check your email.` *(Sounds like an instruction manual)*
-    """
-
-    # get response from the Generative AI model
-    response = chat(transcribed_text, SessionId, system_prompt, model)
-    print("response: ", response)
-
-    # i dont want cot in my audio
-    response = re.sub(r"<think>.*?</think>\s*", "", response, flags=re.DOTALL)
-    # converting to regular text
-    response = md_to_text(response)
-
-    # get audio from the response
-    audio = get_audio(text=response, voice=voice)
+    with span("upload_read"):
+        audio_bytes = await audio.read()
+
+    # decoded straight from memory, nothing is written to disk
+    def preprocess():
+        preprocessor = AudioPreprocessor.from_bytes(audio_bytes)
+        preprocessor.preprocess_audio()
+        return preprocessor
+
+    # one turn of a session at a time, and a bounded number of turns overall
+    async with admission.admit(SessionId) as ticket:
+        try:
+            preprocessor = await stages["preprocess"].run(preprocess)
+        except AudioDecodeError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        for stage, seconds in preprocessor.timings.items():
+            record(stage if stage == "decode" else f"preprocess_{stage}", seconds)
+
+        with span("whisper"):
+            transcribed_text = await stages["stt"].run(
+                transcribe_audio, preprocessor.audio
+            )
+
+        print("transcribed_text: ", transcribed_text)
+
+        if pipeline:
+            # the LLM keeps generating while the answer is spoken
+            await ticket.enter(llm_gate)
+            # taken before the response starts, so a full stage is still a 503
+            await ticket.enter(stages["tts"].gate)
+            tokens = stream_chat(transcribed_text, SessionId, voice_system_prompt, model)
+            # generated off the TTS stage, which is only taken per sentence
+            sentences = iterate_in_thread(read_ahead(speech_sentences(tokens)))
+            return StreamingResponse(
+                ticket.hold(speak(ticket, sentences, voice)), media_type="audio/wav"
+            )
+
+        # get response from the Generative AI model
+        async with llm_gate:
+            with span("ollama"):
+                response = await achat(
+                    transcribed_text, SessionId, voice_system_prompt, model
+                )
+        print("response: ", response)
+
+        with span("speech_text"):
+            # no cot or markdown in my audio
+            response = to_speech_text(response)
+
+        if stream:
+            await ticket.enter(stages["tts"].gate)
+            sentences = iterate_in_thread(split_sentences(response))
+            return StreamingResponse(
+                ticket.hold(speak(ticket, sentences, voice)), media_type="audio/wav"
+            )
+
+        # get audio from the response
+        audio = await stages["tts"].run(get_audio, text=response, voice=voice)
     print("audio is ready", "_" * 50)
     # return the audio
     return StreamingResponse(audio, media_type="audio/wav")
 
 
+@app.websocket("/ws/audio/{SessionId}/{model}/{voice}")
+async def voice_session(
+    websocket: WebSocket,
+    SessionId: str,
+    model: str,
+    voice: str,
+    # the VAD needs whole frames of audio, and Whisper resamples to 16 kHz;
+    # out of range values close the socket with a 1008 policy violation
+    sample_rate: int = Query(16000, ge=8000, le=48000),
+):
+    """
+    Talk with the Generative AI model over a WebSocket: PCM_16 audio is
+    streamed in continuously and the spoken answers are streamed back, see
+    utils.voice_session.VoiceSession for the protocol.
+
+    Args:
+        SessionId (str): The ID of the chat session.
+        voice (str): The voice to use for the text-to-speech model.
+        sample_rate (int): The sample rate of the audio the client sends.
+    """
+    await websocket.accept()
+    session = VoiceSession(
+        websocket, SessionId, model, voice, voice_system_prompt, sample_rate=sample_rate
+    )
+    await session.run()
+
+
 if __name__ == "__main__":
-    SessionId = "test_session_1"
 
-    while (question := input("You: ").strip()) != "exit":
-        print(
-            "Assistant:",
-            text_interaction(question=question, SessionId=SessionId, model="gemma3:1b"),
-        )
+    async def main():
+        # one event loop for the whole session, the async clients and the
+        # gates are bound to the loop they were first used on
+        SessionId = "test_session_1"
+
+        while (question := (await asyncio.to_thread(input, "You: ")).strip()) != "exit":
+            print(
+                "Assistant:",
+                await text_interaction(
+                    question=question, SessionId=SessionId, model="gemma3:1b"
+                ),
+            )
+
+        print(await get_chat_name(SessionId=SessionId, wait=30))
 
-    print(get_chat_name(SessionId=SessionId, model="gemma3:1b"))
+    asyncio.run(main())
@@ -1,6 +1,128 @@
 import librosa
 import numpy as np
 import noisereduce as nr
+import os
+import struct
+import subprocess
+import threading
+import time
+from typing import Union
+
+# the stages run by preprocess_audio, in order. The energy VAD trims noisy
+# leading and trailing silence that librosa's trim (60 dB below the peak)
+# keeps, and the denoising of the baseline stays on: the SNR estimate of
+# auto_denoise rates noisy speech far too clean to decide it by default
+default_pipeline = os.getenv("AUDIO_PREPROCESS_PIPELINE", "vad,denoise,normalize")
+# above this estimated SNR (dB) auto_denoise leaves the audio untouched
+default_snr_threshold = float(os.getenv("AUDIO_SNR_THRESHOLD", "25"))
+# ffmpeg is killed when decoding an upload takes longer than this
+decode_timeout = float(os.getenv("AUDIO_DECODE_TIMEOUT_SECONDS", "30"))
+
+
+class AudioDecodeError(RuntimeError):
+    """
+    Raised when uploaded audio cannot be decoded.
+    """
+
+
+def estimate_decoded_size(audio_bytes: bytes, sr: int) -> int:
+    """
+    Estimate how many bytes of mono f32le audio at `sr` an upload decodes to.
+
+    WAV headers give the exact ratio. Anything else is taken to be
+    compressed speech like the browser's webm/opus: about 32 kbit/s, which
+    is 16 times smaller than f32 audio at 16 kHz.
+
+    Args:
+        audio_bytes (bytes): The encoded audio.
+        sr (int): The sample rate it is decoded to.
+
+    Returns:
+        int: The estimated size of the decoded audio, in bytes.
+    """
+    if audio_bytes[:4] == b"RIFF" and audio_bytes[8:16] == b"WAVEfmt ":
+        channels, rate = struct.unpack_from("<HI", audio_bytes, 22)
+        bits = struct.unpack_from("<H", audio_bytes, 34)[0]
+        if channels and rate and bits:
+            return int(len(audio_bytes) / (channels * bits / 8) * (sr / rate) * 4)
+    return len(audio_bytes) * 16 * sr // 16000
+
+
+def decode_audio(audio_bytes: bytes, sr: int = 16000, timeout: float = decode_timeout) -> np.ndarray:
+    """
+    Decode encoded audio bytes to a mono float32 signal by piping them
+    through ffmpeg.
+
+    Args:
+        audio_bytes (bytes): The encoded audio.
+        sr (int): The sample rate to resample to.
+        timeout (float): Seconds after which ffmpeg is killed.
+
+    Returns:
+        np.ndarray: The decoded float32 signal.
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "f32le", "-ac", "1", "-ar", str(sr),
+        "pipe:1",
+    ]
+    process = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    errors = []
+
+    def feed():
+        try:
+            process.stdin.write(audio_bytes)
+        except BrokenPipeError:
+            # ffmpeg gave up on the input, its exit code reports why
+            pass
+        finally:
+            process.stdin.close()
+
+    # stdin and stderr get their own threads, so no pipe fills up while
+    # another one is waited on
+    writer = threading.Thread(target=feed, daemon=True)
+    drain = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    writer.start()
+    drain.start()
+    timed_out = threading.Event()
+
+    def kill():
+        # closes ffmpeg's pipes, which ends every read and write
+        timed_out.set()
+        process.kill()
+
+    killer = threading.Timer(timeout, kill)
+    killer.start()
+
+    # read straight into a writable buffer the array can own, instead of
+    # into bytes that would have to be copied. It is sized from the upload,
+    # with some slack, so it only grows (and is copied) on a bad estimate
+    buffer = bytearray(max(estimate_decoded_size(audio_bytes, sr) * 9 // 8, 1 << 16))
+    size = 0
+    while True:
+        if size == len(buffer):
+            buffer.extend(bytes(len(buffer)))
+        with memoryview(buffer) as view:
+            read = process.stdout.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    process.stdout.close()
+    writer.join()
+    drain.join()
+    killer.cancel()
+    if process.wait() != 0:
+        if timed_out.is_set():
+            raise AudioDecodeError(f"Failed to decode audio: took longer than {timeout:g}s.")
+        raise AudioDecodeError(f"Failed to decode audio: {b''.join(errors).decode(errors='replace')}")
+    if size == 0:
+        raise AudioDecodeError("Failed to decode audio: it holds no samples.")
+
+    del buffer[size:]
+    return np.frombuffer(buffer, dtype=np.float32)
 
 
 class AudioPreprocessor:
@@ -9,27 +131,138 @@ class AudioPreprocessor:
 
     It provides methods to load an audio file, reduce noise,
     remove silence, and normalize the audio signal.
+
+    The stages run by preprocess_audio are selectable:
+
+    - trim: trim leading and trailing silence (librosa)
+    - vad: trim to the voiced region found by energy VAD
+    - denoise: stationary spectral gating
+    - denoise_nonstationary: non-stationary spectral gating
+    - auto_denoise: stationary denoise, skipped when the SNR is already high
+    - normalize: peak normalization
+
+    Trimming first means the expensive denoise stage never processes the
+    silence that would be thrown away afterwards.
     """
 
-    def __init__(self, audio_path: str):
+    stages = {
+        "trim": "remove_silence",
+        "vad": "trim_with_vad",
+        "denoise": "remove_noise",
+        "denoise_nonstationary": "remove_noise_nonstationary",
+        "auto_denoise": "remove_noise_if_needed",
+        "normalize": "normalize_audio",
+    }
+
+    def __init__(
+        self,
+        audio: Union[str, np.ndarray],
+        sr: int = 16000,
+        pipeline: str = default_pipeline,
+        snr_threshold: float = default_snr_threshold,
+    ):
         """
-        Initialize the AudioPreprocessor with the given audio path.
+        Initialize the AudioPreprocessor with the given audio path or an
+        already decoded audio signal.
 
         Args:
-            audio_path (str): The file path to the audio file.
+            audio (str | np.ndarray): The file path to the audio file, or a
+                mono float32 signal sampled at `sr`.
+            sr (int): The sample rate of the signal.
+            pipeline (str): Comma separated stages run by preprocess_audio.
+            snr_threshold (float): The SNR (dB) above which auto_denoise
+                skips noise reduction.
         """
-        self.audio_path = audio_path
-        self.audio, self.sr = librosa.load(self.audio_path, sr=16000)
+        self.pipeline = [stage.strip() for stage in pipeline.split(",") if stage.strip()]
+        for stage in self.pipeline:
+            if stage not in self.stages:
+                raise ValueError(f"Unknown preprocessing stage: {stage}")
+        self.snr_threshold = snr_threshold
+        self.timings = {}
+
+        if isinstance(audio, np.ndarray):
+            self.audio_path = None
+            self.audio, self.sr = audio, sr
+        else:
+            self.audio_path = audio
+            self.audio, self.sr = librosa.load(self.audio_path, sr=sr)
 
-    def remove_noise(self) -> np.ndarray:
+    @classmethod
+    def from_bytes(cls, audio_bytes: bytes, sr: int = 16000, **kwargs) -> "AudioPreprocessor":
+        """
+        Create an AudioPreprocessor from encoded audio bytes (webm/opus, wav,
+        ...) without writing them to disk.
+
+        Args:
+            audio_bytes (bytes): The encoded audio, as uploaded by the client.
+            sr (int): The sample rate to decode to.
+            **kwargs: Passed on to the constructor.
+
+        Returns:
+            AudioPreprocessor: The preprocessor holding the decoded signal.
+        """
+        start = time.perf_counter()
+        audio = decode_audio(audio_bytes, sr=sr)
+        preprocessor = cls(audio, sr=sr, **kwargs)
+        preprocessor.timings["decode"] = time.perf_counter() - start
+        return preprocessor
+
+    def remove_noise(self, stationary: bool = True) -> np.ndarray:
         """
         Reduce noise in the loaded audio signal.
 
+        Args:
+            stationary (bool): Use stationary spectral gating (fast, for a
+                constant noise floor) instead of the non-stationary one.
+
+        Returns:
+            np.ndarray: The noise-reduced audio signal.
+        """
+        if self.audio.size == 0:
+            return self.audio
+        reduced_noise = nr.reduce_noise(y=self.audio, sr=self.sr, stationary=stationary)
+        return reduced_noise.astype(np.float32, copy=False)
+
+    def remove_noise_nonstationary(self) -> np.ndarray:
+        """
+        Reduce noise with non-stationary spectral gating, slower but better
+        for noise that changes over time.
+
         Returns:
             np.ndarray: The noise-reduced audio signal.
         """
-        reduced_noise = nr.reduce_noise(y=self.audio, sr=self.sr)
-        return reduced_noise
+        return self.remove_noise(stationary=False)
+
+    def estimate_snr(self) -> float:
+        """
+        Estimate the signal-to-noise ratio from the frame energies, taking the
+        quiet frames as noise and the loud frames as speech.
+
+        The loudest frames of speech are well above its average level, so
+        this overestimates the SNR of noisy speech (a 5 dB clip can rate
+        above 25 dB); calibrate AUDIO_SNR_THRESHOLD on your own recordings
+        before putting auto_denoise in the pipeline.
+
+        Returns:
+            float: The estimated SNR in dB.
+        """
+        rms = librosa.feature.rms(y=self.audio)[0]
+        if rms.size == 0:
+            return 0.0
+        noise, signal = np.percentile(rms, [10, 90])
+        return float(20 * np.log10((signal + 1e-10) / (noise + 1e-10)))
+
+    def remove_noise_if_needed(self) -> np.ndarray:
+        """
+        Reduce noise only when the estimated SNR is below the threshold,
+        clean recordings skip the expensive spectral gating.
+
+        Returns:
+            np.ndarray: The (possibly) noise-reduced audio signal.
+        """
+        if self.estimate_snr() >= self.snr_threshold:
+            return self.audio
+        return self.remove_noise()
 
     def remove_silence(self) -> np.ndarray:
         """
@@ -41,25 +274,62 @@ class AudioPreprocessor:
         trimmed_audio, _ = librosa.effects.trim(self.audio)
         return trimmed_audio
 
+    def trim_with_vad(self, frame_ms: int = 30, padding_ms: int = 200) -> np.ndarray:
+        """
+        Trim the audio to the first and last voiced frame, as found by a
+        simple energy based voice activity detection.
+
+        Args:
+            frame_ms (int): The analysis frame length.
+            padding_ms (int): Audio kept around the voiced region.
+
+        Returns:
+            np.ndarray: A view of the voiced part of the audio signal.
+        """
+        frame = int(self.sr * frame_ms / 1000)
+        n_frames = self.audio.size // frame
+        if n_frames == 0:
+            return self.audio
+
+        frames = self.audio[: n_frames * frame].reshape(n_frames, frame)
+        energy = np.sqrt(np.mean(np.square(frames), axis=1))
+        threshold = max(np.percentile(energy, 10) * 3, energy.max() * 0.05)
+        voiced = np.flatnonzero(energy > threshold)
+        if voiced.size == 0:
+            return self.audio[:0]
+
+        padding = int(self.sr * padding_ms / 1000)
+        start = max(voiced[0] * frame - padding, 0)
+        end = min((voiced[-1] + 1) * frame + padding, self.audio.size)
+        return self.audio[start:end]
+
     def normalize_audio(self) -> np.ndarray:
         """
-        Normalize the amplitude of the audio signal.
+        Normalize the amplitude of the audio signal in place.
 
         Returns:
             np.ndarray: The normalized audio signal.
         """
-        normalized = librosa.util.normalize(self.audio)
-        return normalized
+        if self.audio.size == 0:
+            return self.audio
+        peak = np.max(np.abs(self.audio))
+        if peak > 0:
+            if not self.audio.flags.writeable:
+                self.audio = self.audio.copy()
+            np.multiply(self.audio, 1.0 / peak, out=self.audio)
+        return self.audio
 
     def preprocess_audio(self) -> np.ndarray:
         """
-        Perform the full preprocessing pipeline on the audio.
-        This includes noise reduction, silence removal, and normalization.
+        Perform the configured preprocessing pipeline on the audio, recording
+        how long each stage took in `self.timings`.
 
         Returns:
             np.ndarray: The fully preprocessed audio signal.
         """
-        self.audio = self.remove_noise()
-        self.audio = self.remove_silence()
-        self.audio = self.normalize_audio()
+        self.audio = np.asarray(self.audio, dtype=np.float32)
+        for stage in self.pipeline:
+            start = time.perf_counter()
+            self.audio = getattr(self, self.stages[stage])()
+            self.timings[stage] = time.perf_counter() - start
         return self.audio
@@ -1,11 +1,14 @@
 from pydantic import BaseModel, Field, field_validator
-from typing import List, Literal, Dict
+from typing import List, Literal, Dict, Optional
 from bson import ObjectId
 
 
 class ChatSummaryNameOutput(BaseModel):
-    summarized_chat_name: str = Field(
-        ..., description="Summarized chat name within 5 words."
+    summarized_chat_name: Optional[str] = Field(
+        None, description="Summarized chat name within 5 words."
+    )
+    status: Literal["pending", "done"] = Field(
+        "done", description="Whether the chat name is still being generated."
     )
 
 
@@ -31,6 +34,10 @@ class ListChatSessionsOutput(BaseModel):
                 )
         return v
 
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor of the next page, None on the last page."
+    )
+
 
 class EachChatHistory(BaseModel):
 
@@ -0,0 +1,106 @@
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, MongoClient
+from pymongo.errors import OperationFailure
+from bson import ObjectId
+from datetime import datetime, timezone
+from typing import Optional
+import os
+
+mongo_uri = os.getenv("MONGO_URI", "mongodb://db:27017/")
+# the same pool and timeout settings for both clients
+client_options = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_MS", "60000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.getenv("MONGO_TIMEOUT_MS", "5000")),
+}
+
+database_name = "LLM_chats_db"
+
+# the async client serves the endpoints (see utils/repository.py), the
+# sync one the work that already runs on worker threads
+client = MongoClient(mongo_uri, **client_options)
+chat_history_db = client[database_name]
+chat_histories_collection = chat_history_db["chat_histories"]
+chat_meta_collection = chat_history_db["chat_meta"]
+chat_summaries_collection = chat_history_db["chat_summaries"]
+session_leases_collection = chat_history_db["session_leases"]
+
+async_client = AsyncMongoClient(mongo_uri, **client_options)
+async_chat_history_db = async_client[database_name]
+async_chat_histories_collection = async_chat_history_db["chat_histories"]
+async_chat_meta_collection = async_chat_history_db["chat_meta"]
+async_chat_summaries_collection = async_chat_history_db["chat_summaries"]
+async_session_leases_collection = async_chat_history_db["session_leases"]
+
+
+def ensure_indexes() -> None:
+    """
+    Create the indexes the queries rely on, once at startup instead of
+    every time a chat history object is created.
+    """
+    # a session's messages, already in _id (insertion) order
+    chat_histories_collection.create_index([("SessionId", ASCENDING), ("_id", ASCENDING)])
+    # one meta per session: concurrent upserts of two API workers would
+    # otherwise both insert
+    index = chat_meta_collection.index_information().get("SessionId_1")
+    if index is None or not index.get("unique"):
+        removed = dedupe_chat_meta()
+        if removed:
+            print(f"Removed {removed} duplicate chat_meta documents")
+        if index is not None:
+            try:
+                chat_meta_collection.drop_index("SessionId_1")
+            except OperationFailure:
+                # dropped by another worker starting at the same time
+                pass
+    chat_meta_collection.create_index("SessionId", unique=True)
+    # newest sessions first
+    chat_meta_collection.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+    # leases left behind by a crashed process are taken over once expired,
+    # and cleaned up eventually
+    session_leases_collection.create_index("expires_at", expireAfterSeconds=3600)
+
+
+def dedupe_chat_meta() -> int:
+    """
+    Remove the extra chat_meta documents of sessions that have several,
+    left by concurrent upserts before SessionId was a unique index. The
+    oldest named one is kept, or the oldest one if none is named.
+
+    Returns:
+        int: The number of removed documents.
+    """
+    removed = 0
+    duplicates = chat_meta_collection.aggregate([
+        {"$group": {"_id": "$SessionId", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    for group in duplicates:
+        documents = list(
+            chat_meta_collection.find({"_id": {"$in": group["ids"]}}, {"chat_name": 1}).sort("_id", 1)
+        )
+        keep = next((d for d in documents if "chat_name" in d), documents[0])
+        removed += chat_meta_collection.delete_many(
+            {"_id": {"$in": [d["_id"] for d in documents if d is not keep]}}
+        ).deleted_count
+    return removed
+
+
+def now() -> datetime:
+    """
+    Return the creation timestamp stored with new documents.
+    """
+    return datetime.now(timezone.utc)
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[ObjectId]:
+    """
+    Turn a pagination cursor (the _id of the last returned document) back
+    into an ObjectId.
+    """
+    if cursor is None:
+        return None
+    if not ObjectId.is_valid(cursor):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return ObjectId(cursor)
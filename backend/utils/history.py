@@ -0,0 +1,494 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    BaseMessage,
+    SystemMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+from pymongo import UpdateOne
+
+from utils.db import (
+    async_chat_histories_collection,
+    async_chat_summaries_collection,
+    chat_histories_collection,
+    chat_meta_collection,
+    chat_summaries_collection,
+    now,
+)
+
+history_strategy = os.getenv("HISTORY_STRATEGY", "last_n")
+history_max_messages = int(os.getenv("HISTORY_MAX_MESSAGES", "20"))
+history_max_tokens = int(os.getenv("HISTORY_MAX_TOKENS", "2000"))
+# how many of the oldest messages the last_n window drops at once
+history_window_block = int(os.getenv("HISTORY_WINDOW_BLOCK", "10"))
+# how many messages must fall out of the window before the summary is updated
+history_summary_batch = int(os.getenv("HISTORY_SUMMARY_BATCH", "10"))
+# the most messages the summary strategy replays while the summary lags behind
+history_max_unsummarized = int(
+    os.getenv("HISTORY_MAX_UNSUMMARIZED", str(history_max_messages + 4 * history_summary_batch))
+)
+
+
+
+class SummaryScheduler:
+    """
+    Updates summaries after a turn, off the request path, one at a time.
+
+    A session whose update is already queued or running is not queued
+    again, and a session whose update failed waits before the next try,
+    twice as long after each failure, instead of calling the summary model
+    on every turn.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = float(os.getenv("HISTORY_SUMMARY_RETRY_SECONDS", "30")),
+        max_delay: float = 900,
+    ):
+        """
+        Args:
+            base_delay (float): The wait after a first failure, in seconds.
+            max_delay (float): The longest wait between two tries.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+        self._lock = threading.Lock()
+        self._queued = set()
+        # SessionId -> (consecutive failures, monotonic time of the next try)
+        self._failures = {}
+
+    def submit(self, SessionId: str, update: Callable[[], None]) -> Optional[Future]:
+        """
+        Queue a summary update, unless one is queued or the session backs off.
+
+        Returns:
+            Future: The queued update, None when it was skipped.
+        """
+        with self._lock:
+            if SessionId in self._queued:
+                return None
+            if time.monotonic() < self._failures.get(SessionId, (0, 0.0))[1]:
+                return None
+            self._queued.add(SessionId)
+        future = self._executor.submit(update)
+        future.add_done_callback(partial(self._done, SessionId))
+        return future
+
+    def _done(self, SessionId: str, future: Future) -> None:
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            self._queued.discard(SessionId)
+            if error is None:
+                self._failures.pop(SessionId, None)
+                return
+            failures = self._failures.get(SessionId, (0, 0.0))[0] + 1
+            delay = min(self.base_delay * 2 ** (failures - 1), self.max_delay)
+            self._failures[SessionId] = (failures, time.monotonic() + delay)
+        print(
+            f"Failed to update the summary of session {SessionId} "
+            f"({failures} in a row), retrying in {delay:.0f}s: {error!r}"
+        )
+
+
+summary_scheduler = SummaryScheduler()
+
+
+def load_message_dict(document: dict) -> dict:
+    """
+    Return the stored message of a chat_histories document as a dict.
+
+    Messages are stored as native BSON documents; documents written before
+    the migration hold a JSON string instead.
+    """
+    history = document["History"]
+    if isinstance(history, str):
+        history = json.loads(history)
+    return history
+
+
+class MongoChatMessageHistory(BaseChatMessageHistory):
+    """
+    The chat history of a session, stored one message per document.
+
+    Documents look like {"SessionId", "History": <message dict>, "created_at"},
+    the same layout as MongoDBChatMessageHistory but with the message stored
+    as a BSON document instead of a JSON string, so it can be projected and
+    read without decoding.
+    """
+
+    def __init__(self, session_id: str, history_size: Optional[int] = None):
+        """
+        Args:
+            session_id (str): The ID of the chat session.
+            history_size (int): Only read the newest messages, None reads all.
+        """
+        self.session_id = session_id
+        self.history_size = history_size
+
+    def _find(self, collection):
+        cursor = collection.find(
+            {"SessionId": self.session_id}, {"_id": 0, "History": 1}
+        )
+        if self.history_size is None:
+            return cursor.sort("_id", 1)
+        return cursor.sort("_id", -1).limit(self.history_size)
+
+    def _to_messages(self, documents: list) -> List[BaseMessage]:
+        if self.history_size is not None:
+            documents = documents[::-1]
+        return messages_from_dict([load_message_dict(d) for d in documents])
+
+    def _to_documents(self, messages: List[BaseMessage]) -> list:
+        created_at = now()
+        return [
+            {
+                "SessionId": self.session_id,
+                "History": message_to_dict(message),
+                "created_at": created_at,
+            }
+            for message in messages
+        ]
+
+    def _find_from(self, collection, skip: int):
+        return (
+            collection.find({"SessionId": self.session_id}, {"_id": 0, "History": 1})
+            .sort("_id", 1)
+            .skip(skip)
+        )
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """
+        The messages of the session, oldest first.
+        """
+        return self._to_messages(list(self._find(chat_histories_collection)))
+
+    def messages_from(self, skip: int) -> List[BaseMessage]:
+        """
+        The messages of the session after the first `skip`, oldest first.
+        """
+        documents = self._find_from(chat_histories_collection, skip)
+        return messages_from_dict([load_message_dict(d) for d in documents])
+
+    async def amessages_from(self, skip: int) -> List[BaseMessage]:
+        """
+        The messages of the session after the first `skip`, oldest first,
+        read with the async client.
+        """
+        documents = await self._find_from(async_chat_histories_collection, skip).to_list()
+        return messages_from_dict([load_message_dict(d) for d in documents])
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        """
+        The messages of the session, oldest first, read with the async client.
+        """
+        documents = await self._find(async_chat_histories_collection).to_list()
+        return self._to_messages(documents)
+
+    def count(self) -> int:
+        """
+        The number of messages of the session.
+        """
+        return chat_histories_collection.count_documents({"SessionId": self.session_id})
+
+    async def acount(self) -> int:
+        """
+        The number of messages of the session, counted with the async client.
+        """
+        return await async_chat_histories_collection.count_documents({"SessionId": self.session_id})
+
+    def add_messages(self, messages: List[BaseMessage]) -> None:
+        """
+        Save new messages to the session.
+        """
+        chat_histories_collection.insert_many(self._to_documents(messages))
+
+    async def aadd_messages(self, messages: List[BaseMessage]) -> None:
+        """
+        Save new messages to the session with the async client.
+        """
+        await async_chat_histories_collection.insert_many(self._to_documents(messages))
+
+    def clear(self) -> None:
+        """
+        Remove every message of the session.
+        """
+        chat_histories_collection.delete_many({"SessionId": self.session_id})
+
+    async def aclear(self) -> None:
+        """
+        Remove every message of the session with the async client.
+        """
+        await async_chat_histories_collection.delete_many({"SessionId": self.session_id})
+
+
+def estimate_tokens(message: BaseMessage) -> int:
+    """
+    Roughly estimate the tokens of a message, about four characters each.
+    """
+    return len(str(message.content)) // 4 + 4
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Bounds how much of a session's history is replayed into the prompt.
+
+    Strategies:
+
+    - all: the whole history, as before
+    - last_n: the last `max_messages` messages at most, dropping the
+      oldest `window_block` at a time, so the window starts at the same
+      message for several turns and Ollama can reuse the prompt prefix it
+      already evaluated
+    - token_budget: the newest messages that fit in `max_tokens`
+    - summary: every message not yet folded into a stored summary of the
+      older ones, preceded by that summary, which is updated incrementally
+      (so usually between `max_messages` and `max_messages +
+      history_summary_batch` messages, and never more than
+      `history_max_unsummarized` when the summary falls behind)
+
+    Only the window is read from MongoDB, so the per-turn cost stays flat
+    for long-lived sessions.
+    """
+
+    def __init__(
+        self,
+        history: BaseChatMessageHistory,
+        session_id: str,
+        strategy: str = history_strategy,
+        max_messages: int = history_max_messages,
+        max_tokens: int = history_max_tokens,
+        window_block: int = history_window_block,
+        summarize: Optional[Callable[[str, List[BaseMessage]], str]] = None,
+    ):
+        """
+        Args:
+            history (MongoChatMessageHistory): The full history, it should
+                read at most `max_messages` messages unless strategy is all.
+                The summary strategy reads the messages it replays itself.
+            session_id (str): The ID of the chat session.
+            strategy (str): One of all, last_n, token_budget and summary.
+            max_messages (int): The size of the window in messages.
+            max_tokens (int): The size of the window in estimated tokens.
+            window_block (int): How many messages the last_n window drops
+                at once.
+            summarize (Callable): Takes the current summary and the messages
+                to fold into it, returns the new summary.
+        """
+        if strategy not in ("all", "last_n", "token_budget", "summary"):
+            raise ValueError(f"Unknown history strategy: {strategy}")
+        if strategy == "summary" and summarize is None:
+            raise ValueError("The summary strategy needs a summarize function.")
+        self.history = history
+        self.session_id = session_id
+        self.strategy = strategy
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.window_block = max(1, window_block)
+        self.summarize = summarize
+
+    def _window(self, messages: List[BaseMessage], total: Optional[int] = None) -> List[BaseMessage]:
+        if self.strategy == "last_n":
+            # the first message of the window only moves every
+            # `window_block` messages
+            overflow = max(total - self.max_messages, 0)
+            start = -(-overflow // self.window_block) * self.window_block
+            return messages[max(start - (total - len(messages)), 0):]
+
+        messages = messages[-self.max_messages:]
+
+        if self.strategy == "token_budget":
+            budget = self.max_tokens
+            for start in range(len(messages) - 1, -1, -1):
+                budget -= estimate_tokens(messages[start])
+                if budget < 0:
+                    messages = messages[start + 1:]
+                    break
+        return messages
+
+    def _unsummarized_start(self, summary: Optional[dict], total: int) -> int:
+        """
+        Return the index of the first message the summary does not cover.
+        """
+        summarized_count = summary.get("summarized_count", 0) if summary else 0
+        if total - summarized_count > history_max_unsummarized:
+            print(
+                f"The summary of session {self.session_id} is {total - summarized_count} "
+                f"messages behind, only replaying the last {history_max_unsummarized}"
+            )
+            return total - history_max_unsummarized
+        return summarized_count
+
+    def _with_summary(self, summary: Optional[dict], messages: List[BaseMessage]) -> List[BaseMessage]:
+        if summary and summary.get("summary"):
+            messages = [
+                SystemMessage(
+                    content=f"Summary of the earlier conversation: {summary['summary']}"
+                )
+            ] + messages
+        return messages
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """
+        The messages replayed into the prompt.
+        """
+        if self.strategy == "summary":
+            summary = chat_summaries_collection.find_one(
+                {"SessionId": self.session_id}, {"_id": 0, "summary": 1, "summarized_count": 1}
+            )
+            start = self._unsummarized_start(summary, self.history.count())
+            # every message after the summary, so none falls in between
+            return self._with_summary(summary, self.history.messages_from(start))
+
+        messages = self.history.messages
+        if self.strategy == "all":
+            return messages
+        if self.strategy == "last_n":
+            return self._window(messages, self.history.count())
+        return self._window(messages)
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        """
+        The messages replayed into the prompt, read with the async client.
+        """
+        if self.strategy == "last_n":
+            messages, total = await asyncio.gather(
+                self.history.aget_messages(), self.history.acount()
+            )
+            return self._window(messages, total)
+        if self.strategy != "summary":
+            messages = await self.history.aget_messages()
+            return messages if self.strategy == "all" else self._window(messages)
+
+        total, summary = await asyncio.gather(
+            self.history.acount(),
+            async_chat_summaries_collection.find_one(
+                {"SessionId": self.session_id}, {"_id": 0, "summary": 1, "summarized_count": 1}
+            ),
+        )
+        start = self._unsummarized_start(summary, total)
+        # every message after the summary, so none falls in between
+        return self._with_summary(summary, await self.history.amessages_from(start))
+
+    def add_messages(self, messages: List[BaseMessage]) -> None:
+        """
+        Save new messages, then fold what left the window into the summary.
+        """
+        self.history.add_messages(messages)
+        if self.strategy == "summary":
+            summary_scheduler.submit(self.session_id, self.update_summary)
+
+    async def aadd_messages(self, messages: List[BaseMessage]) -> None:
+        """
+        Save new messages with the async client, then fold what left the
+        window into the summary.
+        """
+        await self.history.aadd_messages(messages)
+        if self.strategy == "summary":
+            summary_scheduler.submit(self.session_id, self.update_summary)
+
+    def update_summary(self) -> None:
+        """
+        Fold the messages that fell out of the window into the stored
+        summary, once at least `history_summary_batch` of them piled up.
+        """
+        stored = chat_summaries_collection.find_one({"SessionId": self.session_id}) or {}
+        summarized_count = stored.get("summarized_count", 0)
+        outside_window = (
+            chat_histories_collection.count_documents({"SessionId": self.session_id})
+            - self.max_messages
+        )
+        if outside_window - summarized_count < history_summary_batch:
+            return
+
+        documents = (
+            chat_histories_collection.find(
+                {"SessionId": self.session_id}, {"_id": 0, "History": 1}
+            )
+            .sort("_id", 1)
+            .skip(summarized_count)
+            .limit(outside_window - summarized_count)
+        )
+        new_messages = messages_from_dict(
+            [load_message_dict(document) for document in documents]
+        )
+        summary = self.summarize(stored.get("summary", ""), new_messages)
+
+        chat_summaries_collection.update_one(
+            {"SessionId": self.session_id},
+            {"$set": {"summary": summary, "summarized_count": outside_window}},
+            upsert=True,
+        )
+
+    def clear(self) -> None:
+        """
+        Remove the history and the summary of the session.
+        """
+        self.history.clear()
+        chat_summaries_collection.delete_one({"SessionId": self.session_id})
+
+
+def migrate_history_format(batch_size: int = 1000) -> int:
+    """
+    Convert messages stored as JSON strings to BSON documents and give
+    documents without one a created_at timestamp (taken from their _id).
+
+    It only touches documents still in the old format, so it is safe to run
+    on every startup.
+
+    Returns:
+        int: The number of migrated documents.
+    """
+    migrated = 0
+
+    def flush(collection, updates):
+        nonlocal migrated
+        if updates:
+            migrated += collection.bulk_write(updates, ordered=False).modified_count
+            updates.clear()
+
+    updates = []
+    old_format = {"$or": [{"History": {"$type": "string"}}, {"created_at": {"$exists": False}}]}
+    for document in chat_histories_collection.find(old_format, {"History": 1}):
+        updates.append(
+            UpdateOne(
+                {"_id": document["_id"]},
+                {
+                    "$set": {
+                        "History": load_message_dict(document),
+                        "created_at": document["_id"].generation_time,
+                    }
+                },
+            )
+        )
+        if len(updates) >= batch_size:
+            flush(chat_histories_collection, updates)
+    flush(chat_histories_collection, updates)
+
+    for document in chat_meta_collection.find({"created_at": {"$exists": False}}, {"_id": 1}):
+        updates.append(
+            UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {"created_at": document["_id"].generation_time}},
+            )
+        )
+        if len(updates) >= batch_size:
+            flush(chat_meta_collection, updates)
+    flush(chat_meta_collection, updates)
+
+    return migrated
+
+
+if __name__ == "__main__":
+    print("migrated documents:", migrate_history_format())
@@ -0,0 +1,352 @@
+"""
+The speech models, in-process or in dedicated inference workers.
+
+With INFERENCE_MODE=local (the default) every API process loads Whisper and
+Kokoro itself. With INFERENCE_MODE=remote the API processes load neither:
+transcription and synthesis are dispatched over local IPC
+(multiprocessing.connection) to STT and TTS worker processes, started with
+
+    python -m utils.inference stt --port 7001
+    python -m utils.inference tts --port 7002
+
+so any number of stateless API workers share one fixed model footprint,
+and the STT and TTS workers are scaled independently by listing several
+addresses in STT_WORKER_ADDRESSES / TTS_WORKER_ADDRESSES.
+"""
+
+import argparse
+import io
+import os
+import queue
+import threading
+import types
+from collections import Counter
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+
+inference_mode = os.getenv("INFERENCE_MODE", "local")
+stt_worker_addresses = os.getenv("STT_WORKER_ADDRESSES", "stt:7001").split(",")
+tts_worker_addresses = os.getenv("TTS_WORKER_ADDRESSES", "tts:7002").split(",")
+
+
+class InferenceUnavailable(Exception):
+    """
+    Raised when no inference worker of a stage can be reached.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f"The {stage} inference workers are unavailable, try again later.")
+
+
+class InferenceError(Exception):
+    """
+    Raised when an inference worker failed to handle a call.
+    """
+
+
+def require_authkey() -> bytes:
+    """
+    Return the key shared by the API and the workers.
+
+    Messages are pickled, so whoever can authenticate can run code on the
+    other side: there is no default key, the IPC refuses to start without
+    INFERENCE_AUTHKEY.
+    """
+    authkey = os.getenv("INFERENCE_AUTHKEY")
+    if not authkey:
+        raise RuntimeError("INFERENCE_AUTHKEY must be set to use the inference workers.")
+    return authkey.encode()
+
+
+def parse_address(address: str) -> tuple:
+    host, _, port = address.strip().rpartition(":")
+    return host, int(port)
+
+
+class InferenceClient:
+    """
+    Calls the inference workers of one stage.
+
+    Connections are kept open and reused, one per call in flight, and each
+    call goes to the worker with the fewest calls in flight.
+    """
+
+    def __init__(self, stage: str, addresses: list, authkey: bytes = None):
+        """
+        Args:
+            stage (str): The name of the stage, for errors.
+            addresses (list): The "host:port" of each worker.
+            authkey (bytes): The key the workers authenticate clients with,
+                INFERENCE_AUTHKEY by default.
+        """
+        self.stage = stage
+        self.addresses = [parse_address(address) for address in addresses]
+        self.authkey = authkey or require_authkey()
+        self._idle = {address: queue.SimpleQueue() for address in self.addresses}
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+
+    def _checkout(self, address: tuple = None, fresh: bool = False):
+        with self._lock:
+            if address is None:
+                address = min(self.addresses, key=lambda a: self._in_flight[a])
+            self._in_flight[address] += 1
+        if not fresh:
+            try:
+                return address, self._idle[address].get_nowait(), True
+            except queue.Empty:
+                pass
+        try:
+            return address, Client(address, authkey=self.authkey), False
+        except (OSError, AuthenticationError) as e:
+            self._release(address)
+            print(f"Cannot reach the {self.stage} worker at {address}: {e}")
+            raise InferenceUnavailable(self.stage) from e
+
+    def _release(self, address: tuple, connection=None) -> None:
+        with self._lock:
+            self._in_flight[address] -= 1
+        if connection is not None:
+            self._idle[address].put(connection)
+
+    def _exchange(self, connection, method: str, args: tuple, kwargs: dict):
+        try:
+            connection.send((method, args, kwargs))
+            return connection.recv()
+        except (OSError, EOFError) as e:
+            raise InferenceUnavailable(self.stage) from e
+
+    def _discard_idle(self, address: tuple) -> None:
+        while True:
+            try:
+                self._idle[address].get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _start(self, method: str, args: tuple, kwargs: dict, address: tuple = None):
+        """
+        Send a call and wait for its first reply.
+
+        A pooled connection whose worker restarted fails on first use, it
+        is then dropped (with the other idle ones of that worker) and the
+        call is retried once on a fresh connection.
+
+        Returns:
+            tuple: The address, the connection and the first reply.
+        """
+        address, connection, reused = self._checkout(address)
+        try:
+            return address, connection, self._exchange(connection, method, args, kwargs)
+        except InferenceUnavailable:
+            connection.close()
+            self._release(address)
+            if not reused:
+                raise
+            self._discard_idle(address)
+        except BaseException:
+            connection.close()
+            self._release(address)
+            raise
+
+        address, connection, _ = self._checkout(address, fresh=True)
+        try:
+            return address, connection, self._exchange(connection, method, args, kwargs)
+        except BaseException:
+            connection.close()
+            self._release(address)
+            raise
+
+    def call(self, method: str, *args, address: tuple = None, **kwargs):
+        """
+        Call a method of a worker and wait for its result.
+
+        Args:
+            method (str): The name of the worker's handler.
+            address (tuple): The worker to call, the least busy one when None.
+
+        Returns:
+            The return value of the handler.
+        """
+        address, connection, (kind, value) = self._start(method, args, kwargs, address)
+        self._release(address, connection)
+        if kind == "error":
+            raise InferenceError(value)
+        return value
+
+    def iterate(self, method: str, *args, **kwargs):
+        """
+        Call a generator method of a worker.
+
+        Closing the iterator early (e.g. on barge-in) closes its connection,
+        which stops the worker's generator.
+
+        Yields:
+            The items of the handler's generator.
+        """
+        address, connection, (kind, value) = self._start(method, args, kwargs)
+        try:
+            while kind == "item":
+                yield value
+                try:
+                    kind, value = connection.recv()
+                except (OSError, EOFError) as e:
+                    raise InferenceUnavailable(self.stage) from e
+        except BaseException:
+            connection.close()
+            self._release(address)
+            raise
+        self._release(address, connection)
+        if kind == "error":
+            raise InferenceError(value)
+
+    def broadcast(self, method: str, *args, **kwargs) -> dict:
+        """
+        Call a method on every worker.
+
+        Returns:
+            dict: The result of each worker, by "host:port".
+        """
+        return {
+            f"{host}:{port}": self.call(method, *args, address=(host, port), **kwargs)
+            for host, port in self.addresses
+        }
+
+
+class InferenceServer:
+    """
+    Serves the handlers of one stage to the API processes, one thread per
+    connection. Generator handlers are streamed item by item.
+    """
+
+    def __init__(self, handlers: dict, address: tuple, authkey: bytes = None):
+        """
+        Args:
+            handlers (dict): The functions that can be called, by name.
+            address (tuple): The (host, port) to listen on.
+            authkey (bytes): The key clients must authenticate with,
+                INFERENCE_AUTHKEY by default.
+        """
+        self.handlers = handlers
+        self.address = address
+        self.authkey = authkey or require_authkey()
+
+    def serve_forever(self) -> None:
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Inference worker listening on {self.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, AuthenticationError) as e:
+                    print(f"Rejected an inference connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection) -> None:
+        with connection:
+            while True:
+                try:
+                    method, args, kwargs = connection.recv()
+                except (OSError, EOFError):
+                    return
+                try:
+                    result = self.handlers[method](*args, **kwargs)
+                    if isinstance(result, types.GeneratorType):
+                        try:
+                            for item in result:
+                                connection.send(("item", item))
+                        finally:
+                            # the client went away mid-stream
+                            result.close()
+                        connection.send(("done", None))
+                    else:
+                        connection.send(("result", result))
+                except (OSError, EOFError):
+                    return
+                except Exception as e:
+                    print(f"Error in inference handler {method}: {e}")
+                    connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def stt_handlers() -> dict:
+    from utils.stt import stt_engine, transcribe_audio
+
+    return {
+        "transcribe_audio": transcribe_audio,
+        "warmup": stt_engine.warmup,
+        "memory_stats": stt_engine.memory_stats,
+        "unload": stt_engine.unload,
+    }
+
+
+def tts_handlers() -> dict:
+    from utils.tts import get_audio, stream_audio, synthesize_sentences, tts_engine, voice_names
+    from utils.tts_cache import tts_cache
+
+    def synthesize(sentences: list, voice: str = "bella"):
+        return synthesize_sentences(sentences, voice_names.get(voice, "af_bella"))
+
+    return {
+        "get_audio": lambda text, voice="bella": get_audio(text, voice).getvalue(),
+        "stream_audio": stream_audio,
+        "synthesize": synthesize,
+        "load": tts_engine.load,
+        "cache_stats": tts_cache.stats,
+    }
+
+
+if inference_mode == "remote":
+    stt_client = InferenceClient("stt", stt_worker_addresses)
+    tts_client = InferenceClient("tts", tts_worker_addresses)
+
+    def transcribe_audio(audio) -> str:
+        return stt_client.call("transcribe_audio", audio)
+
+    def get_audio(text: str, voice: str = "bella") -> io.BytesIO:
+        return io.BytesIO(tts_client.call("get_audio", text, voice))
+
+    def stream_audio(text: str, voice: str = "bella"):
+        yield from tts_client.iterate("stream_audio", text, voice)
+
+    def stream_sentence_audio(sentence: str, voice: str = "bella"):
+        yield from tts_client.iterate("synthesize", [sentence], voice)
+
+    def preload_models() -> None:
+        # the workers load their models when they start
+        pass
+
+    def stt_memory_stats() -> dict:
+        return stt_client.broadcast("memory_stats")
+
+    def unload_stt_model(model_name: str) -> None:
+        stt_client.broadcast("unload", model_name)
+
+    def tts_cache_stats() -> dict:
+        return tts_client.broadcast("cache_stats")
+
+else:
+    from utils.stt import stt_engine, transcribe_audio
+    from utils.tts import get_audio, stream_audio, stream_sentence_audio, tts_engine
+    from utils.tts_cache import tts_cache
+
+    def preload_models() -> None:
+        stt_engine.warmup()
+        tts_engine.load()
+
+    stt_memory_stats = stt_engine.memory_stats
+    unload_stt_model = stt_engine.unload
+    tts_cache_stats = tts_cache.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an STT or TTS inference worker.")
+    parser.add_argument("stage", choices=["stt", "tts"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+    authkey = require_authkey()
+
+    handlers = stt_handlers() if args.stage == "stt" else tts_handlers()
+    if os.getenv("PRELOAD_MODELS", "true").lower() == "true":
+        handlers["warmup" if args.stage == "stt" else "load"]()
+    InferenceServer(handlers, (args.host, args.port), authkey).serve_forever()
@@ -1,46 +1,239 @@
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_ollama import ChatOllama
 from langchain_ollama.llms import OllamaLLM
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
 
 from typing import List, Literal
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
 from ollama import Client
 import os
+import json
+import asyncio
+import threading
+import time
+
+from utils.history import (
+    MongoChatMessageHistory,
+    WindowedChatMessageHistory,
+    history_max_messages,
+    history_strategy,
+)
 
 ollama_url = os.environ.get("OLLAMA_URL")
 ollama_client = Client(host=ollama_url)
+summary_model = os.getenv("HISTORY_SUMMARY_MODEL", "gemma3:1b")
+
+# pinned per model so Ollama keeps the model (and its prompt cache) loaded
+# and never reloads it with a different context size, e.g.
+# OLLAMA_MODEL_OPTIONS='{"gemma3:1b": {"num_ctx": 8192, "keep_alive": "30m"}}'
+default_model_options = {
+    "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "10m"),
+    "num_ctx": int(os.getenv("OLLAMA_NUM_CTX", "4096")),
+}
+model_options = json.loads(os.getenv("OLLAMA_MODEL_OPTIONS", "{}"))
+
+# called with (model, stats) after every chat turn
+turn_stats_listeners = []
+
+class ModelInventory:
+    """
+    A TTL cache of the models available on the Ollama server.
+
+    Missing models are pulled by a background worker. Concurrent requests
+    for the same missing model share one pull and wait on it instead of
+    each starting its own download.
+    """
+
+    def __init__(self, ttl: float = float(os.getenv("OLLAMA_MODELS_TTL", "60"))):
+        """
+        Args:
+            ttl (float): Seconds to trust the cached model list.
+        """
+        self.ttl = ttl
+        self._models = set()
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._pulls = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ollama-pull")
+
+    def invalidate(self) -> None:
+        """
+        Forget the cached model list, the next lookup asks the server again.
+        """
+        with self._lock:
+            self._fetched_at = 0.0
+
+    def models(self) -> set:
+        """
+        Return the model names on the server, refreshing them once the TTL
+        has expired.
+        """
+        with self._lock:
+            if time.monotonic() - self._fetched_at > self.ttl:
+                self._models = {
+                    i["model"] for i in ollama_client.list().model_dump()["models"]
+                }
+                self._fetched_at = time.monotonic()
+            return self._models
+
+    def _pull(self, model: str) -> None:
+        try:
+            ollama_client.pull(model)
+            with self._lock:
+                self._models.add(model)
+        except Exception:
+            self.invalidate()
+            raise
+        finally:
+            with self._lock:
+                self._pulls.pop(model, None)
+
+    def pull(self, model: str) -> Future:
+        """
+        Start pulling a model in the background, or join a pull of the same
+        model that is already running.
+
+        Returns:
+            Future: Resolves once the model is downloaded.
+        """
+        with self._lock:
+            future = self._pulls.get(model)
+            if future is None:
+                future = self._executor.submit(self._pull, model)
+                self._pulls[model] = future
+            return future
+
+    def ensure(self, model: str) -> None:
+        """
+        Make sure a model is available, waiting for its download if needed.
+        """
+        if model in self.models():
+            return
+        self.pull(model).result()
+
+
+model_inventory = ModelInventory()
+
 
 def check_model(model: str) -> str:
     """
     This function takes a model name and check if its downloaded or not.
     If not downloaded it will download the model.
     """
-    model_names = [i["model"] for i in ollama_client.list().model_dump()["models"]]
-    if model not in model_names:
-        try:
-            ollama_client.pull(model)
-        except Exception as e:
-            raise Exception(
-                f"""Failed to download model. Please ensure you have ollama 
-                installed and entered correct model name: {str(e)}"""
-            )
+    try:
+        model_inventory.ensure(model)
+    except Exception as e:
+        raise Exception(
+            f"""Failed to download model. Please ensure you have ollama 
+            installed and entered correct model name: {str(e)}"""
+        )
 
 
-def chat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3:1b") -> str:
+def report_turn_stats(model: str, metadata: dict) -> dict:
     """
-    This function takes a question and a session ID, and returns the response
-    from the Generative AI model.
+    This function takes the response metadata of a chat turn and reports
+    how many tokens Ollama evaluated for the prompt versus generated, and
+    how long each took (in seconds).
+    """
+    stats = {
+        "prompt_eval_count": metadata.get("prompt_eval_count", 0),
+        "prompt_eval_duration": metadata.get("prompt_eval_duration", 0) / 1e9,
+        "eval_count": metadata.get("eval_count", 0),
+        "eval_duration": metadata.get("eval_duration", 0) / 1e9,
+        "load_duration": metadata.get("load_duration", 0) / 1e9,
+    }
+    for listener in turn_stats_listeners:
+        listener(model, stats)
+    return stats
+
 
-    It creates a prompt template, a chain with a Generative AI model,
-    and a history with a MongoDB database. It then invokes the chain
-    with the question and the session ID, and returns the response.
+def summarize_history(summary: str, messages: List[BaseMessage]) -> str:
+    """
+    This function takes the running summary of a chat and the messages that
+    are no longer replayed, and returns the summary updated with them.
     """
 
-    check_model(model=model)
+    check_model(model=summary_model)
+
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                (
+                    "You keep a short running summary of a conversation. "
+                    "Update the summary with the new messages, keep facts, "
+                    "names and decisions, and only answer the summary."
+                ),
+            ),
+            (
+                "human",
+                """Current summary:
+                {summary}
+                ------------
+                New messages:
+                {messages}
+                """,
+            ),
+        ]
+    )
+
+    llm = OllamaLLM(model=summary_model, keep_alive="10m", base_url=ollama_url)
+
+    chain = prompt | llm
+
+    return chain.invoke(
+        {
+            "summary": summary or "(empty)",
+            "messages": "\n".join(f"{m.type}: {m.content}" for m in messages),
+        }
+    )
+
+
+def get_session_history(session_id: str, windowed: bool = True) -> BaseChatMessageHistory:
+    """
+    This function takes a session ID and returns its MongoDB chat history,
+    backed by the shared Mongo client.
+
+    Unless windowed is False, only the part of the history chosen by the
+    HISTORY_STRATEGY is replayed into the prompt.
+    """
+    history = MongoChatMessageHistory(
+        session_id,
+        # only read the window from MongoDB
+        history_size=(
+            None if not windowed or history_strategy == "all" else history_max_messages
+        ),
+    )
+    if not windowed:
+        return history
+
+    return WindowedChatMessageHistory(
+        history, session_id, summarize=summarize_history
+    )
 
-    # Create the Generative AI model
-    llm = OllamaLLM(model=model,keep_alive="10m", base_url = ollama_url)
+
+@lru_cache(maxsize=None)
+def get_chain(model: str) -> RunnableWithMessageHistory:
+    """
+    This function takes a model name and returns a chain of the prompt and
+    the Generative AI model, wrapped with the MongoDB chat history.
+
+    The chain is built once per model and reused by every request.
+    """
+
+    # Create the Generative AI model on Ollama's chat endpoint, so the
+    # system prompt and history are sent as a stable message prefix the
+    # server can reuse its prompt cache for
+    options = {**default_model_options, **model_options.get(model, {})}
+    llm = ChatOllama(
+        model=model,
+        keep_alive=options["keep_alive"],
+        num_ctx=options["num_ctx"],
+        base_url=ollama_url,
+    )
 
     # Create the prompt template with system, history, and human messages
     prompt = ChatPromptTemplate.from_messages(
@@ -57,23 +250,117 @@ def chat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3
     # Create the history with a MongoDB database
     chain_with_history = RunnableWithMessageHistory(
         chain,
-        lambda session_id: MongoDBChatMessageHistory(
-            session_id=session_id,
-            connection_string="mongodb://db:27017",
-            database_name="LLM_chats_db",
-            collection_name="chat_histories",
-        ),
+        get_session_history,
         input_messages_key="question",
         history_messages_key="history",
     )
 
+    return chain_with_history
+
+
+def chat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3:1b") -> str:
+    """
+    This function takes a question and a session ID, and returns the response
+    from the Generative AI model.
+
+    It takes the cached chain of the prompt template, the Generative AI
+    model and the MongoDB history, invokes it with the question and the
+    session ID, and returns the response.
+    """
+
+    check_model(model=model)
+
+    chain_with_history = get_chain(model)
+
     # Create the config with the session ID
     config = {"configurable": {"session_id": SessionId}}
 
     # Invoke the chain with the question and the config
     response = chain_with_history.invoke({"question": question, "system_prompt": system_prompt}, config=config)
+    report_turn_stats(model, response.response_metadata)
 
-    return response
+    return response.content
+
+
+def stream_chat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3:1b"):
+    """
+    This function works like chat, but yields the response tokens as the
+    Generative AI model produces them.
+
+    The complete response is saved to the MongoDB chat history once the
+    stream is exhausted.
+    """
+
+    check_model(model=model)
+
+    chain_with_history = get_chain(model)
+
+    config = {"configurable": {"session_id": SessionId}}
+
+    metadata = {}
+    for chunk in chain_with_history.stream(
+        {"question": question, "system_prompt": system_prompt}, config=config
+    ):
+        # the last chunk carries the token counts and durations
+        metadata.update(chunk.response_metadata)
+        if chunk.content:
+            yield chunk.content
+    report_turn_stats(model, metadata)
+
+
+async def achat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3:1b") -> str:
+    """
+    This function is the async version of chat, it awaits the Generative AI
+    model through Ollama's async client instead of blocking a thread.
+    """
+
+    await asyncio.to_thread(check_model, model=model)
+
+    chain_with_history = get_chain(model)
+
+    config = {"configurable": {"session_id": SessionId}}
+
+    response = await chain_with_history.ainvoke(
+        {"question": question, "system_prompt": system_prompt}, config=config
+    )
+    report_turn_stats(model, response.response_metadata)
+
+    return response.content
+
+
+async def astream_chat(question: str, SessionId: str, system_prompt: str, model: str = "gemma3:1b"):
+    """
+    This function is the async version of stream_chat.
+    """
+
+    await asyncio.to_thread(check_model, model=model)
+
+    chain_with_history = get_chain(model)
+
+    config = {"configurable": {"session_id": SessionId}}
+
+    metadata = {}
+    async for chunk in chain_with_history.astream(
+        {"question": question, "system_prompt": system_prompt}, config=config
+    ):
+        metadata.update(chunk.response_metadata)
+        if chunk.content:
+            yield chunk.content
+    report_turn_stats(model, metadata)
+
+
+async def asave_interrupted_turn(question: str, answer: str, SessionId: str) -> None:
+    """
+    This function saves a turn whose answer was cut off before the stream
+    was exhausted, so stream_chat never saved it.
+
+    The question is saved with the part of the answer that was spoken, if
+    any, so the next turn still has it as context.
+    """
+    messages = [HumanMessage(content=question)]
+    if answer:
+        messages.append(AIMessage(content=answer))
+    await get_session_history(SessionId).aadd_messages(messages)
 
 
 def get_chat_history(
@@ -82,15 +369,10 @@ def get_chat_history(
     """
     This function takes a session ID and returns the chat history associated with it.
 
-    It uses the MongoDBChatMessageHistory class to retrieve the chat history
+    It uses the MongoChatMessageHistory class to retrieve the chat history
     from the MongoDB database.
     """
-    chat_message_history = MongoDBChatMessageHistory(
-        connection_string="mongodb://db:27017/",
-        database_name="LLM_chats_db",
-        collection_name="chat_histories",
-        session_id=SessionId,
-    )
+    chat_message_history = get_session_history(SessionId, windowed=False)
 
     human_messages = [
         each_message.content
@@ -100,7 +382,7 @@ def get_chat_history(
     return human_messages
 
 
-def generate_chat_name(SessionId: str, model: str = "gemma3:1b") -> str:
+def generate_chat_name(SessionId: str, model: str = "gemma3:1b", keep_alive="5m") -> str:
     """
     This function takes a session ID and returns a string that summarizes 
     the chat history associated with it.
@@ -137,7 +419,7 @@ def generate_chat_name(SessionId: str, model: str = "gemma3:1b") -> str:
         ]
     )
 
-    llm = OllamaLLM(model=model,keep_alive=0, base_url = ollama_url)
+    llm = OllamaLLM(model=model, keep_alive=keep_alive, base_url=ollama_url)
 
     # Create the chain with the prompt and the LLM
     chain = prompt | llm
@@ -0,0 +1,108 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, multiprocess
+
+# always add the Server-Timing header, otherwise only when the request has
+# an X-Stage-Timings header
+stage_timings_header = os.getenv("STAGE_TIMINGS_HEADER", "false").lower() == "true"
+
+stage_seconds = Histogram(
+    "audio_chat_stage_seconds",
+    "Time spent in each stage of a request.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+request_seconds = Histogram(
+    "audio_chat_request_seconds",
+    "Time until the response (headers) of a request is ready.",
+    ["endpoint"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+ollama_tokens = Histogram(
+    "audio_chat_ollama_tokens",
+    "Tokens Ollama evaluated for the prompt (prompt_eval) or generated (eval) per turn.",
+    ["model", "phase"],
+    buckets=(16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+
+# the stage breakdown of the request being handled, None outside requests
+request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+
+def record(stage: str, seconds: float) -> None:
+    """
+    Record the duration of a stage, in the histogram and in the breakdown
+    of the current request.
+
+    Args:
+        stage (str): The name of the stage.
+        seconds (float): How long it took.
+    """
+    stage_seconds.labels(stage).observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Time the block as one stage of the current request.
+
+    Args:
+        stage (str): The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record_turn_stats(model: str, stats: dict) -> None:
+    """
+    Record Ollama's prompt-eval and generation time and tokens of a turn,
+    a listener for utils.llm.turn_stats_listeners.
+    """
+    record("ollama_prompt_eval", stats["prompt_eval_duration"])
+    record("ollama_eval", stats["eval_duration"])
+    ollama_tokens.labels(model, "prompt_eval").observe(stats["prompt_eval_count"])
+    ollama_tokens.labels(model, "eval").observe(stats["eval_count"])
+
+
+def export() -> bytes:
+    """
+    Render the metrics for Prometheus.
+
+    With several API processes (uvicorn --workers) each one only holds its
+    own samples, so PROMETHEUS_MULTIPROC_DIR must point to a directory
+    shared by the processes and emptied before they start; the samples of
+    all of them are then aggregated from it.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+def server_timing(timings: dict) -> str:
+    """
+    Format a stage breakdown as a Server-Timing header value (milliseconds).
+    """
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+
+
+def queue_wait(timings: dict) -> Optional[float]:
+    """
+    Return the total time a request spent queueing for admission and for
+    stage workers, None when it never queued.
+    """
+    waits = [seconds for stage, seconds in timings.items() if stage.endswith("_queue")]
+    return sum(waits) if waits else None
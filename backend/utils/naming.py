@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from utils.db import chat_meta_collection, now
+from utils.llm import generate_chat_name
+from utils.speech_text import to_speech_text
+
+# the naming model gets its own residency policy instead of keep_alive=0,
+# which unloaded it after every call and cold-loaded it for the next one
+naming_model = os.getenv("NAMING_MODEL", "gemma3:1b")
+naming_keep_alive = os.getenv("NAMING_KEEP_ALIVE", "5m")
+# a pending marker older than this was left by a crashed process
+naming_timeout = float(os.getenv("NAMING_TIMEOUT_SECONDS", "120"))
+
+
+class ChatNamer:
+    """
+    Names chat sessions in the background.
+
+    Jobs are deduplicated per SessionId: asking again for a session that
+    is still being named joins the running job. A `naming_started_at`
+    marker in chat_meta extends this to every API process, and lets any of
+    them tell that the name is pending. The result is written to
+    chat_meta, where clients poll for it.
+    """
+
+    def __init__(self, workers: int = int(os.getenv("NAMING_WORKERS", "1"))):
+        """
+        Args:
+            workers (int): How many sessions are named at once.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-namer")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pending_since() -> datetime:
+        """
+        Return the oldest `naming_started_at` of a job still running.
+        """
+        return now() - timedelta(seconds=naming_timeout)
+
+    def _claim(self, SessionId: str) -> bool:
+        """
+        Mark the session as being named, unless it already has a name or
+        another process is naming it.
+
+        Returns:
+            bool: Whether this process should name the session.
+        """
+        started_at = now()
+        try:
+            result = chat_meta_collection.update_one(
+                {"SessionId": SessionId},
+                {"$setOnInsert": {"created_at": started_at, "naming_started_at": started_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # another worker created the meta at the same time, and claimed it
+            return False
+        if result.upserted_id is not None:
+            return True
+        result = chat_meta_collection.update_one(
+            {
+                "SessionId": SessionId,
+                "chat_name": {"$exists": False},
+                "naming_started_at": {"$not": {"$gt": self.pending_since()}},
+            },
+            {"$set": {"naming_started_at": started_at}},
+        )
+        return result.modified_count == 1
+
+    def _wait_named(self, SessionId: str) -> Optional[str]:
+        """
+        Wait for the name given by another process, if any.
+        """
+        while True:
+            chat_meta = chat_meta_collection.find_one(
+                {
+                    "SessionId": SessionId,
+                    "$or": [
+                        {"chat_name": {"$exists": True}},
+                        {"naming_started_at": {"$gt": self.pending_since()}},
+                    ],
+                },
+                {"_id": 0, "chat_name": 1},
+            )
+            if chat_meta is None or "chat_name" in chat_meta:
+                return chat_meta and chat_meta["chat_name"]
+            time.sleep(0.5)
+
+    def _name(self, SessionId: str) -> Optional[str]:
+        try:
+            if not self._claim(SessionId):
+                return self._wait_named(SessionId)
+            try:
+                chat_name = generate_chat_name(
+                    SessionId=SessionId, model=naming_model, keep_alive=naming_keep_alive
+                )
+            except BaseException:
+                # nothing is pending anymore, the next request starts over
+                chat_meta_collection.delete_one(
+                    {"SessionId": SessionId, "chat_name": {"$exists": False}}
+                )
+                raise
+            # removing cot and markdown from the chat name
+            chat_name = to_speech_text(chat_name)
+
+            # a session that was renamed meanwhile keeps its name
+            chat_meta = chat_meta_collection.find_one_and_update(
+                {"SessionId": SessionId, "chat_name": {"$exists": False}},
+                {"$set": {"chat_name": chat_name}, "$unset": {"naming_started_at": ""}},
+                return_document=ReturnDocument.AFTER,
+            ) or chat_meta_collection.find_one_and_update(
+                {"SessionId": SessionId},
+                {"$unset": {"naming_started_at": ""}},
+                return_document=ReturnDocument.AFTER,
+            )
+            # None when the session was deleted meanwhile
+            return chat_meta["chat_name"] if chat_meta else chat_name
+        finally:
+            with self._lock:
+                self._jobs.pop(SessionId, None)
+
+    def submit(self, SessionId: str) -> Future:
+        """
+        Start naming a session, or join the job already naming it.
+
+        Returns:
+            Future: Resolves to the stored chat name, or None when the
+                session was being named elsewhere and that job failed.
+        """
+        with self._lock:
+            future = self._jobs.get(SessionId)
+            if future is None:
+                future = self._executor.submit(self._name, SessionId)
+                future.add_done_callback(partial(self._done, SessionId))
+                self._jobs[SessionId] = future
+            return future
+
+    @staticmethod
+    def _done(SessionId: str, future: Future) -> None:
+        # nobody may be waiting on the job, so failures are logged here
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            print(f"Failed to name session {SessionId}: {error!r}")
+
+
+chat_namer = ChatNamer()
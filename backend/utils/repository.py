@@ -0,0 +1,256 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from bson import ObjectId
+from pymongo import DESCENDING, DeleteMany, DeleteOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.asynchronous.cursor import AsyncCursor
+
+from utils.db import (
+    async_chat_histories_collection,
+    async_chat_meta_collection,
+    async_chat_summaries_collection,
+    async_client,
+    async_session_leases_collection,
+    database_name,
+    now,
+    parse_cursor,
+)
+
+
+class ChatRepository:
+    """
+    The async data layer of the endpoints.
+
+    Every query goes through the one pooled AsyncMongoClient, so waiting on
+    MongoDB never ties up a threadpool worker.
+    """
+
+    def __init__(self):
+        self._supports_client_bulk_write = None
+
+    async def _client_bulk_write(self) -> bool:
+        # MongoClient.bulk_write spans collections, but needs MongoDB 8.0+
+        if self._supports_client_bulk_write is None:
+            server_info = await async_client.server_info()
+            self._supports_client_bulk_write = server_info["versionArray"][0] >= 8
+        return self._supports_client_bulk_write
+
+    async def find_sessions(self, limit: Optional[int], cursor: Optional[str]) -> AsyncCursor:
+        """
+        Find the sessions after the cursor, newest first.
+
+        Args:
+            limit (int): The page size, all sessions when None. One extra
+                session is returned to tell whether there is a next page.
+            cursor (str): The _id of the last session of the previous page.
+
+        Returns:
+            AsyncCursor: The _id, SessionId and chat_name of each session.
+        """
+        # sessions still being named for the first time are not listed yet
+        query = {"chat_name": {"$exists": True}}
+        last_id = parse_cursor(cursor)
+        if last_id is not None:
+            last = await async_chat_meta_collection.find_one(
+                {"_id": last_id}, {"created_at": 1}
+            )
+            if last is None:
+                raise ValueError(f"Invalid cursor: {cursor}")
+            query["$or"] = [
+                {"created_at": {"$lt": last["created_at"]}},
+                {"created_at": last["created_at"], "_id": {"$lt": last_id}},
+            ]
+
+        sessions = async_chat_meta_collection.find(
+            query, {"_id": 1, "SessionId": 1, "chat_name": 1}
+        ).sort([("created_at", -1), ("_id", -1)])
+        if limit is not None:
+            sessions = sessions.limit(limit + 1)
+        return sessions
+
+    async def find_history(
+        self, SessionId: str, limit: Optional[int], before: Optional[str]
+    ) -> Tuple[AsyncCursor, Optional[str]]:
+        """
+        Find the page of a session's history made of the newest `limit`
+        messages older than the `before` cursor.
+
+        Only _ids are read to find the page bounds, from the (SessionId, _id)
+        index, so the messages themselves are streamed in chronological order.
+
+        Returns:
+            tuple: The cursor over the page's messages, and the cursor of the
+                next (older) page or None when this is the oldest one.
+        """
+        query = {"SessionId": SessionId}
+        before_id = parse_cursor(before)
+        if before_id is not None:
+            query["_id"] = {"$lt": before_id}
+
+        next_cursor = None
+        if limit is not None:
+            # the oldest message of the page, and the one before it if any
+            boundary = await (
+                async_chat_histories_collection.find(query, {"_id": 1})
+                .sort("_id", DESCENDING)
+                .skip(limit - 1)
+                .limit(2)
+                .to_list()
+            )
+            if boundary:
+                query["_id"] = {**query.get("_id", {}), "$gte": boundary[0]["_id"]}
+                if len(boundary) == 2:
+                    next_cursor = str(boundary[0]["_id"])
+
+        messages = async_chat_histories_collection.find(
+            query, {"_id": 1, "History.type": 1, "History.data.content": 1}
+        ).sort("_id", 1)
+        return messages, next_cursor
+
+    async def get_chat_name(self, SessionId: str, pending_since: datetime) -> Tuple[Optional[str], bool]:
+        """
+        Return the chat name of a session, None if it has none yet, and
+        whether it is being named.
+
+        Args:
+            SessionId (str): The ID of the chat session.
+            pending_since (datetime): Naming jobs started before this are
+                considered failed.
+        """
+        chat_meta = await async_chat_meta_collection.find_one(
+            {
+                "SessionId": SessionId,
+                "$or": [
+                    {"chat_name": {"$exists": True}},
+                    {"naming_started_at": {"$gt": pending_since}},
+                ],
+            },
+            {"_id": 0, "chat_name": 1},
+        )
+        if chat_meta is None:
+            return None, False
+        return chat_meta.get("chat_name"), "chat_name" not in chat_meta
+
+    async def rename_session(self, SessionId: str, chat_name: str) -> None:
+        """
+        Set the chat name of a session, creating its meta if needed.
+        """
+        try:
+            await async_chat_meta_collection.update_one(
+                {"SessionId": SessionId},
+                {"$set": {"chat_name": chat_name}, "$setOnInsert": {"created_at": now()}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # created by another worker meanwhile, it exists now
+            await async_chat_meta_collection.update_one(
+                {"SessionId": SessionId}, {"$set": {"chat_name": chat_name}}
+            )
+
+    async def delete_session(self, SessionId: str) -> None:
+        """
+        Delete the history, meta and summary of a session in one batched call.
+        """
+        if await self._client_bulk_write():
+            await async_client.bulk_write(
+                [
+                    DeleteMany({"SessionId": SessionId}, namespace=f"{database_name}.chat_histories"),
+                    DeleteOne({"SessionId": SessionId}, namespace=f"{database_name}.chat_meta"),
+                    DeleteOne({"SessionId": SessionId}, namespace=f"{database_name}.chat_summaries"),
+                ],
+                ordered=False,
+            )
+            return
+
+        await asyncio.gather(
+            async_chat_histories_collection.delete_many({"SessionId": SessionId}),
+            async_chat_meta_collection.delete_one({"SessionId": SessionId}),
+            async_chat_summaries_collection.delete_one({"SessionId": SessionId}),
+        )
+
+
+class SessionLease:
+    """
+    A lease on a session, stored in MongoDB, so the turns of a session run
+    one at a time across API processes and not only within one.
+
+    A lease expires `ttl` seconds after it was last renewed, and is renewed
+    while held, so the lease of a crashed process is taken over once it
+    expires.
+    """
+
+    def __init__(self, ttl: float = float(os.getenv("SESSION_LEASE_SECONDS", "30")), max_poll: float = 0.25):
+        """
+        Args:
+            ttl (float): How long a lease outlives its holder, in seconds.
+            max_poll (float): The longest wait between two attempts to take
+                a held lease, in seconds.
+        """
+        self.ttl = ttl
+        self.max_poll = max_poll
+        # token -> the task renewing its lease
+        self._renewals = {}
+        self._releases = set()
+
+    async def acquire(self, SessionId: str) -> str:
+        """
+        Wait until the session is free and take its lease.
+
+        Returns:
+            str: The token of the lease, to release it with.
+        """
+        token = str(ObjectId())
+        delay = 0.01
+        while True:
+            current = now()
+            try:
+                # takes a missing or expired lease, and fails with a
+                # duplicate key on a held one
+                await async_session_leases_collection.update_one(
+                    {"_id": SessionId, "expires_at": {"$lt": current}},
+                    {"$set": {"owner": token, "expires_at": current + timedelta(seconds=self.ttl)}},
+                    upsert=True,
+                )
+                break
+            except DuplicateKeyError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll)
+        self._renewals[token] = asyncio.create_task(self._renew(SessionId, token))
+        return token
+
+    async def _renew(self, SessionId: str, token: str) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await async_session_leases_collection.update_one(
+                    {"_id": SessionId, "owner": token},
+                    {"$set": {"expires_at": now() + timedelta(seconds=self.ttl)}},
+                )
+            except Exception as e:
+                # retried on the next renewal, well before the lease expires
+                print(f"Failed to renew the lease of session {SessionId}: {e}")
+
+    def release(self, SessionId: str, token: str) -> None:
+        """
+        Give the lease back. Safe to call outside of a coroutine: the lease
+        then simply expires.
+        """
+        renewal = self._renewals.pop(token, None)
+        if renewal is not None:
+            renewal.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(
+            async_session_leases_collection.delete_one({"_id": SessionId, "owner": token})
+        )
+        # keep a reference until it is done
+        self._releases.add(task)
+        task.add_done_callback(self._releases.discard)
+
+
+chat_repository = ChatRepository()
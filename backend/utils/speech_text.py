@@ -0,0 +1,314 @@
+import re
+from typing import Iterable, Iterator
+
+# a sentence ends at terminal punctuation (plus closing quotes/brackets)
+# followed by whitespace, or at a line break
+sentence_end = re.compile(r"[.!?…]+[\"'”’)\]]*\s+|\n+")
+
+# the markdown that decides what a line is, matched at its start
+block_syntax = re.compile(
+    r"(?P<fence>\s*(?:```|~~~))"
+    r"|(?P<rule>\s*([-*_])(?:\s*\3){2,}\s*$)"
+    r"|(?P<table_rule>\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$)"
+    r"|(?P<table>\s*\|\s*)"
+    r"|(?P<prefix>(?:\s*(?:#{1,6}\s+|>\s?|[-*+]\s+|\d+[.)]\s+))+)"
+)
+# characters a line can start with before it is clear which block it is
+block_chars = set(" \t#>-*+_=~`|:.)0123456789")
+
+# inline markdown, in priority order
+inline_syntax = re.compile(
+    # Kokoro's pronunciation syntax, [word](/phonemes/) or [word](+1), is kept
+    r"(?P<kokoro>\[[^\]\n]+\]\((?:/[^)\n]*/|[+-]\d+(?:\.\d+)?)\))"
+    r"|!\[(?P<alt>[^\]\n]*)\]\([^)\n]*\)"
+    r"|\[(?P<link>[^\]\n]+)\]\([^)\n]*\)"
+    r"|(?<!`)(?P<ticks>`+)(?!`)(?P<code>[^\n]+?)(?<!`)(?P=ticks)(?!`)"
+    r"|<(?P<url>https?://[^>\s]+)>"
+    r"|</?[A-Za-z][^>\n]*>"
+    r"|\\(?P<escaped>[\\`*_{}\[\]()#+\-.!|>~])"
+    # emphasis markers, but not a spaced out "2 * 3" or snake_case
+    r"|(?<=\S)[*~]+|[*~]+(?=\S)|(?<!\w)_+|_+(?!\w)"
+)
+# the start of an inline construct that is not complete yet
+unfinished_syntax = re.compile(
+    r"(?:!?\[[^\]\n]*(?:\](?:\([^)\n]*)?)?|`[^\n]*|<[^>\s]*|[*_~\\!]+)$"
+)
+
+
+class ThinkFilter:
+    """
+    Incrementally removes <think>...</think> spans from a token stream.
+
+    Tokens can split a tag anywhere, so a possible partial tag at the end
+    of a chunk is held back until the next chunk decides it.
+    """
+
+    open_tag = "<think>"
+    close_tag = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self.pending = ""
+        # whitespace after a closing tag is dropped, even in later chunks
+        self.after_close = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Feed the next chunk of the stream.
+
+        Args:
+            chunk (str): The next tokens from the model.
+
+        Returns:
+            str: The text outside of reasoning blocks that is now final.
+        """
+        text = self.pending + chunk
+        self.pending = ""
+        output = []
+
+        while True:
+            if self.after_close:
+                # same as the trailing \s* of the old regex
+                text = text.lstrip()
+                self.after_close = not text
+            if not text:
+                break
+            tag = self.close_tag if self.in_think else self.open_tag
+            index = text.find(tag)
+            if index != -1:
+                if not self.in_think:
+                    output.append(text[:index])
+                text = text[index + len(tag):]
+                self.after_close = self.in_think
+                self.in_think = not self.in_think
+                continue
+
+            # hold back a suffix that could be the start of the tag
+            keep = 0
+            for size in range(min(len(tag) - 1, len(text)), 0, -1):
+                if tag.startswith(text[-size:]):
+                    keep = size
+                    break
+            if not self.in_think:
+                output.append(text[: len(text) - keep])
+            self.pending = text[len(text) - keep:]
+            break
+
+        return "".join(output)
+
+    def flush(self) -> str:
+        """
+        Return whatever is still held back once the stream has ended.
+        """
+        pending, self.pending = self.pending, ""
+        return "" if self.in_think else pending
+
+
+class SpeechNormalizer:
+    """
+    Incrementally turns markdown into text for TTS, in a single pass.
+
+    Reasoning blocks and fenced code blocks are dropped. Headers, list
+    markers, quotes and table rules are removed, links, images and inline
+    code are reduced to their text, and emphasis markers and HTML tags are
+    stripped. Kokoro's pronunciation syntax, [word](/phonemes/), is kept.
+
+    Text is released as soon as it can no longer change meaning, so the
+    normalizer can run on streamed tokens: the start of a line is held back
+    until its block type is known, and an inline construct until it closes
+    (or its line ends).
+    """
+
+    # an unclosed construct longer than this is released as plain text
+    max_held = 200
+
+    def __init__(self):
+        self.think_filter = ThinkFilter()
+        self.pending = ""
+        self.line_start = True
+        self.in_code = False
+        self.in_table = False
+        # the last character released, for the emphasis lookbehinds
+        self.previous = "\n"
+
+    def feed(self, chunk: str) -> str:
+        """
+        Feed the next chunk of the stream.
+
+        Args:
+            chunk (str): The next tokens from the model.
+
+        Returns:
+            str: The speech text that is now final.
+        """
+        self.pending += self.think_filter.feed(chunk)
+        return self._drain(final=False)
+
+    def flush(self) -> str:
+        """
+        Return the speech text still held back once the stream has ended.
+        """
+        self.pending += self.think_filter.flush()
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> str:
+        output = []
+        while self.pending:
+            newline = self.pending.find("\n")
+            line = self.pending if newline == -1 else self.pending[:newline]
+            complete = newline != -1 or final
+
+            if self.line_start:
+                if not complete and (self.in_code or set(line) <= block_chars):
+                    break
+                block = block_syntax.match(line)
+                kind = block.lastgroup if block else None
+
+                if self.in_code or kind in ("fence", "rule", "table_rule"):
+                    if not complete:
+                        break
+                    if kind == "fence":
+                        self.in_code = not self.in_code
+                    self.pending = self.pending[len(line) + 1:]
+                    continue
+
+                self.line_start = False
+                self.in_table = kind == "table"
+                if block is not None:
+                    self.pending = self.pending[block.end():]
+                    line = line[block.end():]
+                    if newline != -1:
+                        newline -= block.end()
+
+            if newline == -1:
+                text, held = self._inline(line, final)
+                output.append(text)
+                self.pending = held
+                break
+
+            output.append(self._inline(line, True)[0] + "\n")
+            self.previous = "\n"
+            self.pending = self.pending[newline + 1:]
+            self.line_start = True
+
+        return "".join(output)
+
+    def _inline(self, line: str, complete: bool) -> tuple:
+        # the previous character is only context for the lookbehinds
+        text = self.previous + (line.replace("|", ",") if self.in_table else line)
+        matches = list(inline_syntax.finditer(text, 1))
+
+        # release everything but a construct that more text could change
+        cut = len(text)
+        if not complete:
+            if matches and matches[-1].end() == cut:
+                cut = matches.pop().start()
+            start = matches[-1].end() if matches else 1
+            unfinished = unfinished_syntax.search(text, start, cut)
+            if unfinished:
+                cut = unfinished.start()
+            if len(text) - cut > self.max_held:
+                return self._inline(line, True)
+
+        output = []
+        last = 1
+        for match in matches:
+            output.append(text[last:match.start()])
+            # every kept part is in a named group, markers have none
+            output.append(match.group(match.lastgroup) if match.lastgroup else "")
+            last = match.end()
+        output.append(text[last:cut])
+
+        if cut > 1:
+            self.previous = text[cut - 1]
+        return "".join(output), line[cut - 1:]
+
+
+def to_speech_text(text: str) -> str:
+    """
+    Turn a complete markdown response into text for TTS.
+
+    Args:
+        text (str): The response of the model.
+
+    Returns:
+        str: The speech text.
+    """
+    normalizer = SpeechNormalizer()
+    return (normalizer.feed(text) + normalizer.flush()).strip()
+
+
+class SentenceSplitter:
+    """
+    Buffers streamed text and emits it one complete sentence at a time.
+    """
+
+    def __init__(self, min_length: int = 20):
+        """
+        Args:
+            min_length (int): Sentences shorter than this are joined with the
+                next one, so TTS is not fed tiny fragments.
+        """
+        self.min_length = min_length
+        self.buffer = ""
+
+    def feed(self, chunk: str) -> list:
+        """
+        Feed the next chunk of text.
+
+        Args:
+            chunk (str): The next piece of the response.
+
+        Returns:
+            list: The sentences completed by this chunk.
+        """
+        self.buffer += chunk
+        sentences = []
+        start = 0
+        for match in sentence_end.finditer(self.buffer):
+            if match.end() - start < self.min_length and "\n" not in match.group():
+                continue
+            sentence = self.buffer[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> list:
+        """
+        Return the trailing text once the stream has ended.
+        """
+        sentence, self.buffer = self.buffer.strip(), ""
+        return [sentence] if sentence else []
+
+
+def split_sentences(text: str) -> list:
+    """
+    Split text into the sentences that are synthesized (and cached) one
+    at a time.
+    """
+    splitter = SentenceSplitter()
+    return splitter.feed(text) + splitter.flush()
+
+
+def speech_sentences(tokens: Iterable[str]) -> Iterator[str]:
+    """
+    Turn a stream of model tokens into speakable sentences.
+
+    The stream is normalized to speech text as it arrives, then split into
+    sentences.
+
+    Args:
+        tokens (Iterable[str]): The streamed response of the model.
+
+    Yields:
+        str: The speech text of each completed sentence.
+    """
+    normalizer = SpeechNormalizer()
+    splitter = SentenceSplitter()
+
+    for token in tokens:
+        yield from splitter.feed(normalizer.feed(token))
+
+    yield from splitter.feed(normalizer.flush()) + splitter.flush()
@@ -0,0 +1,128 @@
+import asyncio
+import contextvars
+import queue
+import struct
+import threading
+
+# Kokoro synthesizes 24 kHz audio
+tts_sample_rate = 24000
+
+
+def wav_header(samplerate: int = tts_sample_rate) -> bytes:
+    """
+    Build a PCM_16 mono WAV header for a stream of unknown length.
+
+    The RIFF and data sizes are set to the maximum value, which players
+    treat as "read until the stream ends".
+
+    Args:
+        samplerate (int): The sample rate of the audio that follows.
+
+    Returns:
+        bytes: The 44 byte WAV header.
+    """
+    unknown_size = 0xFFFFFFFF
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        unknown_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,  # PCM
+        1,  # mono
+        samplerate,
+        samplerate * 2,
+        2,
+        16,
+        b"data",
+        unknown_size,
+    )
+
+
+def read_ahead(iterable, maxsize: int = 16):
+    """
+    Consume an iterable in a background thread, so its producer (the LLM)
+    keeps generating while the caller is busy (synthesizing speech).
+
+    When the caller stops early, the producer stops too and the iterable is
+    closed, so an interrupted answer is not generated to the end.
+
+    Args:
+        iterable: The iterable to consume.
+        maxsize (int): How many items may be buffered ahead of the caller.
+
+    Yields:
+        The items of the iterable, in order.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    error = []
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except Exception as e:
+            error.append(e)
+        finally:
+            if stopped.is_set() and hasattr(iterable, "close"):
+                iterable.close()
+            put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while (item := items.get()) is not done:
+            yield item
+    finally:
+        stopped.set()
+    if error:
+        raise error[0]
+
+
+async def iterate_in_thread(iterable):
+    """
+    Iterate a blocking iterable from async code, each item being fetched
+    on a thread of the default executor, so a slow producer (the LLM)
+    neither blocks the event loop nor holds a worker of a stage.
+
+    Args:
+        iterable: The blocking iterable.
+
+    Yields:
+        The items of the iterable, in order.
+    """
+    iterator = iter(iterable)
+    loop = asyncio.get_running_loop()
+    # keep the request's context (e.g. its stage timings) on the thread
+    context = contextvars.copy_context()
+    done = object()
+    pending = None
+    try:
+        while True:
+            pending = loop.run_in_executor(None, context.run, next, iterator, done)
+            # shielded, so a cancelled caller still sees the fetch running
+            item = await asyncio.shield(pending)
+            if item is done:
+                break
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            if pending is not None and not pending.done():
+                # stopped mid-item, close once the item is fetched
+                pending.add_done_callback(lambda _: close())
+            else:
+                close()
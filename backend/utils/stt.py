@@ -1,23 +1,418 @@
 import whisper
+import threading
+import queue
+import time
+import os
+import numpy as np
+import torch
+from concurrent.futures import Future
 
+# comma separated whisper sizes to keep resident, the first one is the default
+whisper_models = [
+    name.strip()
+    for name in os.getenv("WHISPER_MODELS", "base.en").split(",")
+    if name.strip()
+]
+stt_backend = os.getenv("STT_BACKEND", "whisper")
 
-def transcribe_audio(audio_file_path: str) -> str:
+
+def format_result(text: str, segments: list, language: str) -> dict:
     """
-    Transcribes audio bytes using the Whisper ASR model.
+    Build the transcription result every backend returns.
 
     Args:
-        audio_bytes (bytes): The audio data bytes (expected in webm/opus format).
+        text (str): The full transcript.
+        segments (list): Dicts with the id, start, end and text of a segment.
+        language (str): The detected or forced language.
 
     Returns:
-        str: The transcribed text.
+        dict: The transcription result.
+    """
+    return {"text": text, "segments": segments, "language": language}
+
+
+class WhisperBackend:
+    """
+    The openai-whisper backend, fp32 PyTorch on CPU (fp16 on CUDA).
+    """
+
+    name = "whisper"
+
+    def load(self, model_name: str):
+        """
+        Load the weights of a Whisper model size.
+        """
+        return whisper.load_model(model_name, in_memory=True)
+
+    def transcribe(self, model, audio: np.ndarray) -> dict:
+        """
+        Transcribe one 16 kHz float32 audio signal.
+        """
+        result = model.transcribe(audio, fp16=model.device.type == "cuda")
+        segments = [
+            {
+                "id": segment["id"],
+                "start": segment["start"],
+                "end": segment["end"],
+                "text": segment["text"],
+            }
+            for segment in result["segments"]
+        ]
+        return format_result(result["text"], segments, result["language"])
+
+    def transcribe_batch(self, model, audios: list) -> list:
+        """
+        Transcribe several 16 kHz float32 audio signals in one forward pass.
+
+        Clips of up to 30 s are padded to one mel segment each and decoded
+        together. Longer clips need the sliding window of transcribe and
+        are transcribed one by one.
+        """
+        results = [None] * len(audios)
+        short = [
+            i for i, audio in enumerate(audios)
+            if audio.shape[-1] <= whisper.audio.N_SAMPLES
+        ]
+
+        if short:
+            mel = torch.stack([
+                whisper.log_mel_spectrogram(
+                    whisper.pad_or_trim(audios[i]), model.dims.n_mels
+                )
+                for i in short
+            ]).to(model.device)
+            options = whisper.DecodingOptions(
+                language=None if model.is_multilingual else "en",
+                without_timestamps=True,
+                fp16=model.device.type == "cuda",
+            )
+            for i, decoded in zip(short, whisper.decode(model, mel, options)):
+                # same silence check as transcribe
+                silent = decoded.no_speech_prob > 0.6 and decoded.avg_logprob < -1
+                text = "" if silent else decoded.text
+                duration = audios[i].shape[-1] / whisper.audio.SAMPLE_RATE
+                segments = [{"id": 0, "start": 0.0, "end": duration, "text": text}] if text else []
+                results[i] = format_result(text, segments, decoded.language)
+
+        for i, audio in enumerate(audios):
+            if results[i] is None:
+                results[i] = self.transcribe(model, audio)
+
+        return results
+
+    def memory_stats(self, model) -> dict:
+        """
+        Report the memory held by the weights of a loaded model.
+        """
+        parameters = list(model.parameters())
+        return {
+            "parameters": sum(p.numel() for p in parameters),
+            "bytes": sum(p.numel() * p.element_size() for p in parameters),
+            "device": str(model.device),
+        }
+
+
+class FasterWhisperBackend:
     """
-    model = whisper.load_model("base.en", in_memory=True)
+    The faster-whisper backend, CTranslate2 with int8 quantized weights,
+    several times faster and smaller than fp32 PyTorch on CPU.
+    """
+
+    name = "faster-whisper"
+
+    def __init__(
+        self,
+        device: str = os.getenv("STT_DEVICE", "cpu"),
+        compute_type: str = os.getenv("STT_COMPUTE_TYPE", "int8"),
+        cpu_threads: int = int(os.getenv("STT_CPU_THREADS", "0")),
+    ):
+        """
+        Args:
+            device (str): The CTranslate2 device, cpu or cuda.
+            compute_type (str): The quantization of the weights.
+            cpu_threads (int): Threads per transcription, 0 lets CT2 decide.
+        """
+        self.device = device
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+
+    def load(self, model_name: str):
+        """
+        Load (and quantize on the fly) a Whisper model size.
+        """
+        # optional dependency, only needed when this backend is selected
+        from faster_whisper import WhisperModel
+
+        return WhisperModel(
+            model_name,
+            device=self.device,
+            compute_type=self.compute_type,
+            cpu_threads=self.cpu_threads,
+        )
+
+    def transcribe(self, model, audio: np.ndarray) -> dict:
+        """
+        Transcribe one 16 kHz float32 audio signal.
+        """
+        language = None if model.model.is_multilingual else "en"
+        segments, info = model.transcribe(audio, language=language)
+        # segments is lazy, decoding happens while iterating it
+        segments = [
+            {"id": i, "start": segment.start, "end": segment.end, "text": segment.text}
+            for i, segment in enumerate(segments)
+        ]
+        text = "".join(segment["text"] for segment in segments)
+        return format_result(text, segments, info.language)
+
+    def transcribe_batch(self, model, audios: list) -> list:
+        """
+        Transcribe several audio signals, one after the other.
+        """
+        return [self.transcribe(model, audio) for audio in audios]
+
+    def memory_stats(self, model) -> dict:
+        """
+        Report how a loaded model is placed, CTranslate2 does not expose the
+        size of its weights.
+        """
+        return {"device": self.device, "compute_type": self.compute_type}
+
+
+backends = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+}
+
+
+class STTEngine:
+    """
+    A process-wide registry of loaded speech-to-text models.
+
+    Each model size is loaded once (at startup or lazily on first use) by
+    the configured backend, kept resident and guarded by its own lock, so
+    concurrent requests share the weights instead of loading them again
+    for every call.
+    """
+
+    def __init__(self, model_names: list = whisper_models, backend: str = stt_backend):
+        """
+        Initialize the STTEngine with the model sizes it is allowed to serve.
+
+        Args:
+            model_names (list): Whisper model sizes, the first is the default.
+            backend (str): The name of the backend in `backends`.
+        """
+        if backend not in backends:
+            raise ValueError(f"Unknown STT backend '{backend}', expected one of {list(backends)}.")
+        self.backend = backends[backend]()
+        self.model_names = list(model_names)
+        self.default_model = self.model_names[0]
+        self._models = {}
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def get_model(self, model_name: str = None):
+        """
+        Return a loaded model, loading it on first use.
+
+        Args:
+            model_name (str): The Whisper model size, defaults to the first one.
+
+        Returns:
+            The resident model of the backend.
+        """
+        return self._checkout(model_name or self.default_model)[0]
+
+    def _checkout(self, model_name: str) -> tuple:
+        """
+        Return a model and its lock, loading the model on first use.
 
-    # Save with the correct extension for whisper/ffmpeg
+        Both are read under the registry lock, so an unload cannot remove
+        the lock between fetching the model and fetching its lock.
+        """
+        if model_name not in self.model_names:
+            raise ValueError(f"Whisper model '{model_name}' is not configured.")
+        with self._registry_lock:
+            if model_name not in self._models:
+                self._models[model_name] = self.backend.load(model_name)
+                self._locks[model_name] = threading.Lock()
+            return self._models[model_name], self._locks[model_name]
 
-    # Ensure the file is properly closed before passing the path to whisper
+    def _run(self, model_name: str, fn):
+        """
+        Call fn with a model while holding its lock, loading the model again
+        if it was unloaded before the lock was taken.
+        """
+        model_name = model_name or self.default_model
+        while True:
+            model, lock = self._checkout(model_name)
+            with lock:
+                if self._models.get(model_name) is model:
+                    return fn(model)
+
+    def warmup(self, model_names: list = None) -> None:
+        """
+        Load the given (or all configured) models and run one dummy inference
+        so the first real request does not pay the initialization cost.
+
+        Args:
+            model_names (list): The model sizes to warm up, defaults to all.
+        """
+        for model_name in model_names or self.model_names:
+            self.transcribe(np.zeros(16000, dtype=np.float32), model_name)
+
+    def transcribe(self, audio: np.ndarray, model_name: str = None) -> dict:
+        """
+        Transcribe a 16 kHz float32 audio signal with a resident model.
+
+        Args:
+            audio (np.ndarray): The preprocessed audio signal.
+            model_name (str): The Whisper model size, defaults to the first one.
+
+        Returns:
+            dict: The text, segments and language of the transcription.
+        """
+        return self._run(model_name, lambda model: self.backend.transcribe(model, audio))
+
+    def transcribe_batch(self, audios: list, model_name: str = None) -> list:
+        """
+        Transcribe several 16 kHz float32 audio signals as one batch.
+
+        Args:
+            audios (list): The preprocessed audio signals.
+            model_name (str): The Whisper model size, defaults to the first one.
+
+        Returns:
+            list: One transcription result per audio signal.
+        """
+        return self._run(model_name, lambda model: self.backend.transcribe_batch(model, audios))
+
+    def unload(self, model_name: str = None) -> None:
+        """
+        Drop a resident model (or all of them) and release its memory.
+
+        Args:
+            model_name (str): The model size to unload, defaults to all.
+        """
+        with self._registry_lock:
+            names = [model_name] if model_name else list(self._models)
+            locks = [self._locks.pop(name) for name in names if name in self._locks]
+            for name in names:
+                self._models.pop(name, None)
+
+        # wait for in-flight transcriptions outside the registry lock, so
+        # other models stay usable meanwhile; _run sees the model is gone
+        for lock in locks:
+            with lock:
+                pass
+
+        import gc
+
+        gc.collect()
+
+    def memory_stats(self) -> dict:
+        """
+        Report the resident models and the memory held by their weights.
+
+        Returns:
+            dict: Model size to the stats reported by the backend.
+        """
+        return {
+            name: {"backend": self.backend.name, **self.backend.memory_stats(model)}
+            for name, model in list(self._models.items())
+        }
+
+
+stt_engine = STTEngine()
+
+
+class BatchScheduler:
+    """
+    Collects the audio of concurrent requests for a short window and
+    transcribes it as one batch, then hands each request its own result.
+    """
+
+    def __init__(self, engine: STTEngine, max_batch_size: int, max_wait_ms: float):
+        """
+        Args:
+            engine (STTEngine): The engine running the batches.
+            max_batch_size (int): The most clips transcribed in one batch.
+            max_wait_ms (float): How long the first clip of a batch waits
+                for others to join.
+        """
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, audio: np.ndarray) -> Future:
+        """
+        Queue an audio signal for the next batch.
+
+        Returns:
+            Future: Resolves to the Whisper transcription result.
+        """
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="stt-batcher", daemon=True
+                )
+                self._thread.start()
+        future = Future()
+        self._queue.put((audio, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                results = self.engine.transcribe_batch([audio for audio, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+stt_batch_size = int(os.getenv("STT_BATCH_SIZE", "1"))
+stt_batcher = (
+    BatchScheduler(stt_engine, stt_batch_size, float(os.getenv("STT_BATCH_WAIT_MS", "50")))
+    if stt_batch_size > 1
+    else None
+)
+
+
+def transcribe_audio(audio: np.ndarray) -> str:
+    """
+    Transcribes audio using the Whisper ASR model.
+
+    Args:
+        audio (np.ndarray): The preprocessed 16 kHz float32 audio signal.
+
+    Returns:
+        str: The transcribed text.
+    """
     try:
-        result = model.transcribe(audio_file_path)
+        if stt_batcher is not None:
+            result = stt_batcher.submit(audio).result()
+        else:
+            result = stt_engine.transcribe(audio)
         the_text = result["text"]
         print(the_text)
         return the_text
@@ -25,9 +420,3 @@ def transcribe_audio(audio_file_path: str) -> str:
         print(f"Error during transcription: {e}")  # Improved error logging
         # Optionally re-raise or return an error indicator
         return ""  # Return empty string on error for now
-    finally:
-        # Clean up the temporary file
-        import os
-
-        if os.path.exists(audio_file_path):
-            os.remove(audio_file_path)
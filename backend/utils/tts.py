@@ -1,7 +1,17 @@
-from kokoro import KPipeline
+from kokoro import KModel, KPipeline
 import soundfile as sf
 import io
-import torch 
+import os
+import queue
+import threading
+from contextlib import ExitStack, contextmanager
+import numpy as np
+import torch
+
+from utils.metrics import span
+from utils.speech_text import split_sentences
+from utils.streaming import tts_sample_rate, wav_header
+from utils.tts_cache import tts_cache
 
 voice_names = {
     "default": "af_bella",
@@ -18,6 +28,107 @@ voice_names = {
     "lewis": "bm_lewis",
 }
 
+repo_id = "hexgrad/Kokoro-82M"
+sample_rate = tts_sample_rate
+tts_pool_size = int(os.getenv("TTS_POOL_SIZE", "1"))
+
+
+class TTSEngine:
+    """
+    A long-lived pool of Kokoro pipelines.
+
+    All pipelines share one KModel and one set of preloaded voicepacks,
+    so a request only borrows a pipeline instead of reloading the model,
+    the G2P stack and the voice on every call.
+    """
+
+    def __init__(self, pool_size: int = tts_pool_size):
+        """
+        Initialize the TTSEngine, pipelines are created on first use.
+
+        Args:
+            pool_size (int): How many requests can synthesize in parallel.
+        """
+        self.pool_size = max(1, pool_size)
+        self._pool = queue.Queue()
+        self._voices = {}
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+    def load(self) -> None:
+        """
+        Load the shared model, build the pipeline pool and preload the
+        voicepacks of every entry in voice_names.
+        """
+        with self._load_lock:
+            if self._loaded:
+                return
+
+            model = KModel(repo_id=repo_id).eval()
+            for _ in range(self.pool_size):
+                pipeline = KPipeline(lang_code="a", repo_id=repo_id, model=model)
+                # every pipeline shares the same voicepack tensors
+                pipeline.voices = self._voices
+                self._pool.put(pipeline)
+
+            pipeline = self._pool.get()
+            try:
+                for voice in set(voice_names.values()):
+                    pipeline.load_voice(voice)
+            finally:
+                self._pool.put(pipeline)
+
+            self._loaded = True
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Borrow a pipeline from the pool for the duration of the block.
+
+        Yields:
+            KPipeline: A pipeline nobody else is using.
+        """
+        if not self._loaded:
+            self.load()
+        pipeline = self._pool.get()
+        try:
+            yield pipeline
+        finally:
+            self._pool.put(pipeline)
+
+
+tts_engine = TTSEngine()
+
+
+def synthesize_sentences(sentences, voice: str):
+    """
+    Synthesize sentences one at a time, serving repeated ones from the TTS
+    cache. A pipeline is only borrowed once a sentence misses the cache.
+
+    Args:
+        sentences (Iterable[str]): The speech text, one sentence at a time.
+        voice (str): The Kokoro voice id.
+
+    Yields:
+        bytes: The PCM_16 audio of each sentence.
+    """
+    with ExitStack() as stack:
+        pipeline = None
+        for sentence in sentences:
+            audio = tts_cache.get(voice, sentence)
+            if audio is None:
+                if pipeline is None:
+                    pipeline = stack.enter_context(tts_engine.pipeline())
+                with span("kokoro"):
+                    audio = b"".join(
+                        to_pcm16(chunk)
+                        for _, _, chunk in pipeline(sentence, voice=voice)
+                        if chunk is not None
+                    )
+                tts_cache.put(voice, sentence, audio)
+            yield audio
+
+
 def get_audio(text: str, voice: str = "bella") -> bytes:
     """
     Converts text to audio using Kokoro's text-to-speech model.
@@ -30,19 +141,59 @@ def get_audio(text: str, voice: str = "bella") -> bytes:
         generator: The generated audio in wav format (PCM_16) as a generator.
     """
     voice = voice_names.get(voice, "af_bella")
-    pipeline = KPipeline(lang_code="a", repo_id="hexgrad/Kokoro-82M")
-    generator = pipeline(text, voice=voice)
-
-    audio_chunks = []
-    for _, _, audio in generator:
-        audio_chunks.append(audio)
-
-    full_audio = torch.concatenate(audio_chunks)
-    numpy_full_audio = full_audio.numpy()
-    
-    buf = io.BytesIO()
-    sf.write(buf, numpy_full_audio, samplerate=24000, format='wav')
-    buf.seek(0)
-    
+
+    pcm = b"".join(synthesize_sentences(split_sentences(text), voice))
+    numpy_full_audio = np.frombuffer(pcm, dtype=np.int16)
+
+    with span("wav_encode"):
+        buf = io.BytesIO()
+        sf.write(buf, numpy_full_audio, samplerate=sample_rate, format='wav', subtype='PCM_16')
+        buf.seek(0)
+
     return buf
 
+
+def to_pcm16(audio: torch.Tensor) -> bytes:
+    """
+    Convert a float audio chunk in [-1, 1] to little endian PCM_16 bytes.
+
+    Args:
+        audio (torch.Tensor): The audio chunk from the Kokoro pipeline.
+
+    Returns:
+        bytes: The PCM_16 samples.
+    """
+    return (audio.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes()
+
+
+def stream_audio(text: str, voice: str = "bella"):
+    """
+    Converts text to audio, yielding each sentence as soon as Kokoro has
+    synthesized it instead of waiting for the whole answer.
+
+    Args:
+        text (str): The text to convert to audio.
+        voice (str): The voice to use for the text-to-speech model.
+
+    Yields:
+        bytes: A streaming WAV header followed by PCM_16 sentences.
+    """
+    voice = voice_names.get(voice, "af_bella")
+
+    yield wav_header()
+    yield from synthesize_sentences(split_sentences(text), voice)
+
+
+def stream_sentence_audio(sentence: str, voice: str = "bella"):
+    """
+    Converts one sentence of an answer that is still being generated to
+    audio, so the TTS stage is only taken for as long as the sentence takes.
+
+    Args:
+        sentence (str): The speech text of the sentence.
+        voice (str): The voice to use for the text-to-speech model.
+
+    Yields:
+        bytes: The PCM_16 chunks of the sentence.
+    """
+    yield from synthesize_sentences([sentence], voice_names.get(voice, "af_bella"))
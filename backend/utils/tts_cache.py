@@ -0,0 +1,135 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize speech text so trivially different sentences share one entry.
+
+    Case and punctuation are kept, they change how Kokoro speaks.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class TTSCache:
+    """
+    A content-addressed cache of synthesized sentences.
+
+    Entries are keyed by a hash of the voice and the normalized speech text
+    and hold PCM_16 audio. An in-memory LRU tier is bounded by a byte
+    budget; an optional on-disk tier keeps what the memory tier evicts.
+    """
+
+    def __init__(self, max_bytes: int, directory: str = None):
+        """
+        Args:
+            max_bytes (int): The memory budget of the LRU tier, 0 disables it.
+            directory (str): Where to keep the on-disk tier, None disables it.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(voice: str, text: str) -> str:
+        """
+        Return the cache key of a sentence spoken by a voice.
+        """
+        return hashlib.sha256(f"{voice}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.pcm")
+
+    def _remember(self, key: str, audio: bytes) -> None:
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = audio
+            self.size += len(audio)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, voice: str, text: str):
+        """
+        Look up a sentence.
+
+        Returns:
+            bytes | None: The PCM_16 audio, or None on a miss.
+        """
+        key = self.key(voice, text)
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return audio
+
+        if self.directory:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self.disk_hits += 1
+                self._remember(key, audio)
+                return audio
+
+        self.misses += 1
+        return None
+
+    def put(self, voice: str, text: str, audio: bytes) -> None:
+        """
+        Store the PCM_16 audio of a sentence in both tiers.
+        """
+        key = self.key(voice, text)
+        self._remember(key, audio)
+
+        if self.directory:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so readers never see a partial file; the
+            # temporary name is unique across the workers sharing the cache
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(path), suffix=".tmp", delete=False
+            ) as f:
+                f.write(audio)
+            try:
+                os.replace(f.name, path)
+            except OSError:
+                os.remove(f.name)
+                raise
+
+    def stats(self) -> dict:
+        """
+        Report the hit and miss counters and the size of the memory tier.
+        """
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+tts_cache = TTSCache(
+    max_bytes=int(os.getenv("TTS_CACHE_MB", "64")) * 1024 * 1024,
+    directory=os.getenv("TTS_CACHE_DIR") or None,
+)
@@ -0,0 +1,405 @@
+import asyncio
+import json
+import os
+import threading
+from functools import partial
+from typing import Optional
+
+import librosa
+import numpy as np
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
+
+from utils.llm import asave_interrupted_turn, stream_chat
+from utils.speech_text import speech_sentences
+from utils.inference import InferenceUnavailable, stream_sentence_audio, transcribe_audio
+from utils.streaming import iterate_in_thread, read_ahead, tts_sample_rate
+from utils.workers import SessionBusy, StageOverloaded, admission, llm_gate, stages
+
+# silence that ends an utterance, and how often the growing utterance is
+# transcribed while the user is still speaking
+vad_silence_ms = int(os.getenv("VOICE_VAD_SILENCE_MS", "700"))
+partial_interval_ms = int(os.getenv("VOICE_PARTIAL_INTERVAL_MS", "1000"))
+# user speech interrupts the answer being spoken
+barge_in = os.getenv("VOICE_BARGE_IN", "true").lower() == "true"
+
+stt_sample_rate = 16000
+
+
+class EnergyVAD:
+    """
+    A streaming, energy based voice activity detector.
+
+    Frames are voiced when their RMS energy is well above an adaptive noise
+    floor. Speech starts after `start_ms` of voiced frames and ends after
+    `silence_ms` of unvoiced ones.
+    """
+
+    def __init__(
+        self,
+        sr: int,
+        frame_ms: int = 30,
+        start_ms: int = 90,
+        silence_ms: int = vad_silence_ms,
+        ratio: float = 3.0,
+        min_energy: float = 0.005,
+    ):
+        """
+        Args:
+            sr (int): The sample rate of the audio.
+            frame_ms (int): The analysis frame length.
+            start_ms (int): Voiced audio needed to start an utterance.
+            silence_ms (int): Unvoiced audio needed to end an utterance.
+            ratio (float): How far above the noise floor voiced frames are.
+            min_energy (float): The lowest energy counted as voiced.
+        """
+        self.frame = int(sr * frame_ms / 1000)
+        self.start_frames = max(1, start_ms // frame_ms)
+        self.silence_frames = max(1, silence_ms // frame_ms)
+        self.ratio = ratio
+        self.min_energy = min_energy
+        self.noise_floor = min_energy
+        self.speaking = False
+        self.voiced = False
+        self._voiced = 0
+        self._unvoiced = 0
+
+    def process(self, frame: np.ndarray) -> Optional[str]:
+        """
+        Classify the next frame.
+
+        Args:
+            frame (np.ndarray): `self.frame` float32 samples.
+
+        Returns:
+            str: "start" when speech starts, "pause" on the first unvoiced
+                frame of an utterance, "end" when the utterance ends, and
+                None otherwise.
+        """
+        energy = float(np.sqrt(np.mean(np.square(frame))))
+        voiced = self.voiced = energy > max(self.noise_floor * self.ratio, self.min_energy)
+        if not voiced:
+            # follow the background noise, slowly
+            self.noise_floor = 0.95 * self.noise_floor + 0.05 * max(energy, 1e-4)
+
+        if voiced:
+            self._voiced += 1
+            self._unvoiced = 0
+            if not self.speaking and self._voiced >= self.start_frames:
+                self.speaking = True
+                return "start"
+            return None
+
+        self._voiced = 0
+        if not self.speaking:
+            return None
+        self._unvoiced += 1
+        if self._unvoiced == 1:
+            return "pause"
+        if self._unvoiced >= self.silence_frames:
+            self.speaking = False
+            self._unvoiced = 0
+            return "end"
+        return None
+
+    def reset(self) -> None:
+        """
+        End the current utterance, if any, without waiting for silence.
+        """
+        self.speaking = False
+        self._voiced = 0
+        self._unvoiced = 0
+
+
+class VoiceSession:
+    """
+    A full duplex voice conversation over one WebSocket.
+
+    The client streams little endian PCM_16 mono frames (binary messages)
+    at `sample_rate`. Utterances are found with an energy VAD, and the
+    growing utterance is transcribed while the user speaks and again as
+    soon as they pause, so the transcript is usually ready by the time the
+    silence ends it. The answer is streamed back as PCM_16 frames at 24 kHz.
+    Speech from the user while an answer plays cancels it (barge-in), so
+    clients should capture with echo cancellation on.
+
+    Besides the audio, the server sends JSON text messages:
+    {"type": "speech_start"}, {"type": "partial", "text"},
+    {"type": "transcript", "text"}, {"type": "response_start",
+    "sample_rate"}, {"type": "response_end"}, {"type": "interrupted"} and
+    {"type": "error", "error"}. The client may send {"type": "end"} to end
+    the utterance without waiting for silence and {"type": "cancel"} to
+    stop the answer.
+    """
+
+    # audio kept from before speech starts, so the onset is not clipped
+    preroll_ms = 300
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        SessionId: str,
+        model: str,
+        voice: str,
+        system_prompt: str,
+        sample_rate: int = stt_sample_rate,
+    ):
+        """
+        Args:
+            websocket (WebSocket): The accepted WebSocket.
+            SessionId (str): The chat session the turns are saved to.
+            model (str): The Ollama model answering.
+            voice (str): The voice of the answers.
+            system_prompt (str): The system prompt of the answers.
+            sample_rate (int): The sample rate of the client's audio, at
+                least 8 kHz.
+        """
+        if sample_rate < 8000:
+            raise ValueError(f"The sample rate must be at least 8000 Hz, not {sample_rate}.")
+        self.websocket = websocket
+        self.SessionId = SessionId
+        self.model = model
+        self.voice = voice
+        self.system_prompt = system_prompt
+        self.sample_rate = sample_rate
+        self.vad = EnergyVAD(sample_rate)
+
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._preroll = np.zeros(0, dtype=np.float32)
+        self._utterance = []
+        self._utterance_size = 0
+        self._voiced_end = 0
+        self._last_partial_at = 0
+        # the latest transcription: (samples it covers, text)
+        self._transcript = (0, "")
+        self._transcribing: Optional[asyncio.Task] = None
+        self._response: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+
+    async def send_json(self, message: dict) -> None:
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message))
+
+    async def send_bytes(self, data: bytes) -> None:
+        async with self._send_lock:
+            await self.websocket.send_bytes(data)
+
+    async def send_error(self, error: str) -> None:
+        """
+        Report an error to the client, unless it is already gone.
+        """
+        if self.websocket.client_state != WebSocketState.CONNECTED:
+            return
+        try:
+            await self.send_json({"type": "error", "error": error})
+        except (WebSocketDisconnect, RuntimeError):
+            # closed while sending
+            pass
+
+    async def run(self) -> None:
+        """
+        Handle the session until the client disconnects.
+        """
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes"):
+                    await self.feed(message["bytes"])
+                elif message.get("text"):
+                    try:
+                        control = json.loads(message["text"])
+                    except json.JSONDecodeError:
+                        await self.send_error("Control messages must be JSON.")
+                        continue
+                    await self.control(control)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in (self._transcribing, self._response):
+                if task is not None:
+                    task.cancel()
+
+    async def control(self, message: dict) -> None:
+        """
+        Handle a control message of the client.
+        """
+        if not isinstance(message, dict):
+            await self.send_error("Control messages must be JSON objects.")
+            return
+        if message.get("type") == "end" and self._utterance:
+            self.vad.reset()
+            await self.end_utterance()
+        elif message.get("type") == "cancel":
+            await self.interrupt()
+
+    async def feed(self, data: bytes) -> None:
+        """
+        Add PCM_16 audio from the client and act on the VAD events.
+        """
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+        self._pending = np.concatenate([self._pending, samples])
+
+        frame = self.vad.frame
+        n_frames = self._pending.size // frame
+        frames = self._pending[: n_frames * frame].reshape(n_frames, frame)
+        self._pending = self._pending[n_frames * frame :]
+
+        for audio in frames:
+            was_speaking = self.vad.speaking
+            event = self.vad.process(audio)
+
+            if event == "start":
+                await self.start_utterance()
+            if was_speaking or event == "start":
+                self._append(audio)
+                if self.vad.voiced:
+                    self._voiced_end = self._utterance_size
+            else:
+                preroll = int(self.sample_rate * self.preroll_ms / 1000)
+                self._preroll = np.concatenate([self._preroll, audio])[-preroll:]
+
+            if event == "pause":
+                # the whole utterance so far, likely its final transcript
+                self.transcribe()
+            elif event == "end":
+                await self.end_utterance()
+            elif self.vad.speaking and self._utterance_size - self._last_partial_at >= (
+                self.sample_rate * partial_interval_ms // 1000
+            ):
+                self.transcribe()
+
+    def _append(self, audio: np.ndarray) -> None:
+        self._utterance.append(audio)
+        self._utterance_size += audio.size
+
+    async def start_utterance(self) -> None:
+        if barge_in:
+            await self.interrupt()
+        self._utterance = []
+        self._utterance_size = 0
+        self._append(self._preroll)
+        self._preroll = np.zeros(0, dtype=np.float32)
+        self._voiced_end = self._utterance_size
+        self._last_partial_at = 0
+        self._transcript = (0, "")
+        await self.send_json({"type": "speech_start"})
+
+    async def interrupt(self) -> None:
+        """
+        Stop the answer being spoken, if any.
+        """
+        if self._response is not None and not self._response.done():
+            self._response.cancel()
+            await self.send_json({"type": "interrupted"})
+
+    def _resampled(self, audio: np.ndarray) -> np.ndarray:
+        if self.sample_rate == stt_sample_rate:
+            return audio
+        return librosa.resample(audio, orig_sr=self.sample_rate, target_sr=stt_sample_rate)
+
+    def transcribe(self) -> None:
+        """
+        Transcribe the utterance so far in the background, unless a
+        transcription is already running.
+        """
+        if self._transcribing is not None and not self._transcribing.done():
+            return
+        self._last_partial_at = self._utterance_size
+        self._transcribing = asyncio.create_task(self._transcribe_partial(self._utterance_size))
+
+    async def _transcribe_partial(self, size: int) -> None:
+        try:
+            await self._transcribe(size)
+        except StageOverloaded:
+            # a partial is only a head start, the final transcription retries
+            pass
+        except Exception as e:
+            print(f"Partial transcription failed: {e}")
+
+    async def _transcribe(self, size: int) -> str:
+        audio = np.concatenate(self._utterance)[:size]
+        text = await stages["stt"].run(transcribe_audio, self._resampled(audio))
+        if size > self._transcript[0]:
+            self._transcript = (size, text)
+            if self.vad.speaking:
+                await self.send_json({"type": "partial", "text": text})
+        return text
+
+    async def end_utterance(self) -> None:
+        """
+        Finish the transcript of the utterance and start answering it.
+        """
+        if self._transcribing is not None and not self._transcribing.done():
+            await asyncio.shield(self._transcribing)
+        covered, text = self._transcript
+        if covered < self._voiced_end:
+            try:
+                text = await self._transcribe(self._utterance_size)
+            except (StageOverloaded, InferenceUnavailable) as e:
+                await self.send_error(str(e))
+                return
+            except Exception as e:
+                print(f"Transcription failed: {e}")
+                await self.send_error("The transcription failed.")
+                return
+        self._utterance = []
+        self._utterance_size = 0
+
+        await self.send_json({"type": "transcript", "text": text})
+        if text.strip():
+            # answers never overlap, even without barge-in
+            await self.interrupt()
+            self._response = asyncio.create_task(self.respond(text))
+
+    async def respond(self, text: str) -> None:
+        """
+        Stream the spoken answer to a transcript.
+        """
+        try:
+            # turns share the admission control of the HTTP endpoints
+            async with admission.admit(self.SessionId) as ticket:
+                await ticket.enter(llm_gate)
+                spoken = []
+                generated = threading.Event()
+
+                def tokens():
+                    yield from stream_chat(text, self.SessionId, self.system_prompt, self.model)
+                    # stream_chat has saved the turn
+                    generated.set()
+
+                async def sentences():
+                    # generated off the TTS stage, which is only taken per sentence
+                    async for sentence in iterate_in_thread(read_ahead(speech_sentences(tokens()))):
+                        spoken.append(sentence)
+                        yield sentence
+
+                await self.send_json({"type": "response_start", "sample_rate": tts_sample_rate})
+                try:
+                    async for chunk in stages["tts"].iterate_each(
+                        sentences(), partial(stream_sentence_audio, voice=self.voice)
+                    ):
+                        await self.send_bytes(chunk)
+                except (asyncio.CancelledError, WebSocketDisconnect):
+                    # barge-in or a disconnect closed the answer early, keep
+                    # the question and what was spoken of the answer
+                    if not generated.is_set():
+                        try:
+                            await asyncio.shield(
+                                asave_interrupted_turn(text, " ".join(spoken), self.SessionId)
+                            )
+                        except Exception as e:
+                            print(f"Saving the interrupted answer failed: {e}")
+                    raise
+            await self.send_json({"type": "response_end"})
+        except (StageOverloaded, SessionBusy, InferenceUnavailable) as e:
+            await self.send_error(str(e))
+        except WebSocketDisconnect:
+            # the client left mid answer
+            pass
+        except Exception as e:
+            # the task is never awaited, so nothing else would report it;
+            # CancelledError (barge-in) is not an Exception and still cancels it
+            print(f"Voice answer failed: {e}")
+            await self.send_error("The answer failed.")
@@ -0,0 +1,426 @@
+import asyncio
+import contextvars
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.metrics import record
+
+
+class StageOverloaded(Exception):
+    """
+    Raised when a stage already has as many requests waiting as its queue
+    depth allows.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f"The {stage} stage is overloaded, try again later.")
+
+
+def stage_config(name: str, workers: int, queue_depth: int) -> tuple:
+    """
+    Read the concurrency and queue depth of a stage from the
+    STAGE_<NAME>_WORKERS and STAGE_<NAME>_QUEUE environment variables.
+    """
+    prefix = f"STAGE_{name.upper()}"
+    return (
+        int(os.getenv(f"{prefix}_WORKERS", workers)),
+        int(os.getenv(f"{prefix}_QUEUE", queue_depth)),
+    )
+
+
+class SessionBusy(Exception):
+    """
+    Raised when a session already has as many requests waiting for its
+    turn as the session queue allows.
+    """
+
+    def __init__(self, SessionId: str):
+        self.SessionId = SessionId
+        super().__init__(f"Session {SessionId} is busy with earlier requests, try again later.")
+
+
+class Gate:
+    """
+    A concurrency cap with a bounded queue.
+
+    At most `limit` holders at once, at most `queue_depth` more may wait,
+    and the rest are rejected right away with StageOverloaded. The time
+    spent waiting is recorded as the `<name>_queue` stage of the request.
+    """
+
+    def __init__(self, name: str, limit: int, queue_depth: int):
+        """
+        Args:
+            name (str): The name of the stage the gate guards.
+            limit (int): How many holders are allowed at once.
+            queue_depth (int): How many may wait for a free slot.
+        """
+        self.name = name
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.waiting = 0
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls, name: str, limit: int = 1, queue_depth: int = 8):
+        """
+        Create a gate configured by the STAGE_<NAME>_WORKERS and
+        STAGE_<NAME>_QUEUE environment variables.
+        """
+        return cls(name, *stage_config(name, limit, queue_depth))
+
+    async def acquire(self, reject: bool = True) -> None:
+        """
+        Wait for a free slot.
+
+        Args:
+            reject (bool): Raise StageOverloaded when the queue is full. A
+                request that is already streaming its response waits
+                instead, it can no longer be answered with a 503.
+        """
+        # created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if reject and self._semaphore.locked() and self.waiting >= self.queue_depth:
+            raise StageOverloaded(self.name)
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            record(f"{self.name}_queue", time.perf_counter() - start)
+
+    def release(self) -> None:
+        self._semaphore.release()
+
+    async def __aenter__(self) -> "Gate":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+
+class StagePool:
+    """
+    A bounded worker pool for one CPU-heavy or blocking stage of a request.
+
+    The work runs on the pool's own threads, so the event loop stays free,
+    at most `workers` calls run at once and at most `queue_depth` more may
+    wait for a free worker before new calls are rejected.
+    """
+
+    def __init__(self, name: str, workers: int, queue_depth: int):
+        """
+        Args:
+            name (str): The name of the stage.
+            workers (int): How many calls of this stage can run at once.
+            queue_depth (int): How many calls may wait for a free worker.
+        """
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.gate = Gate(name, workers, queue_depth)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"stage-{name}"
+        )
+
+    @classmethod
+    def from_env(cls, name: str, workers: int = 1, queue_depth: int = 8):
+        """
+        Create a stage pool configured by the STAGE_<NAME>_WORKERS and
+        STAGE_<NAME>_QUEUE environment variables.
+        """
+        return cls(name, *stage_config(name, workers, queue_depth))
+
+    @property
+    def waiting(self) -> int:
+        return self.gate.waiting
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run a blocking function on the stage's workers.
+
+        Returns:
+            The return value of the function.
+        """
+        await self.gate.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            # keep the request's context (e.g. its stage timings) on the worker
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self._executor, context.run, partial(fn, *args, **kwargs)
+            )
+        finally:
+            self.gate.release()
+
+    async def iterate(self, generator, acquire: bool = True):
+        """
+        Drive a blocking generator on the stage's workers, holding one worker
+        slot until the generator is exhausted.
+
+        Args:
+            generator: The blocking generator.
+            acquire (bool): Take the worker slot when iteration starts. Pass
+                False when the caller already holds it (e.g. through a
+                Ticket), so a full stage is rejected before a streaming
+                response has started.
+
+        Yields:
+            The items of the generator.
+        """
+        if acquire:
+            await self.gate.acquire()
+        pending = None
+        context = contextvars.copy_context()
+        try:
+            done = object()
+            while True:
+                pending = self._executor.submit(context.run, next, generator, done)
+                item = await asyncio.wrap_future(pending)
+                if item is done:
+                    break
+                yield item
+        finally:
+            if pending is not None and not pending.done():
+                # the client went away mid-chunk, close once it is finished
+                pending.add_done_callback(lambda _: generator.close())
+            else:
+                generator.close()
+            if acquire:
+                self.gate.release()
+
+    async def iterate_each(self, items, fn, held=None):
+        """
+        Drive the blocking generator `fn(item)` of each item of an async
+        iterable on the stage's workers, taking a worker slot per item
+        instead of for the whole iterable. The stage stays free for other
+        requests while the producer of the items (e.g. the LLM writing the
+        next sentence) is busy.
+
+        Args:
+            items: The async iterable, produced outside of the stage.
+            fn (Callable): Returns the blocking generator of one item.
+            held (Callable): Releases a slot the caller took in advance
+                (e.g. through Ticket.enter, so a full stage is rejected
+                before a streaming response has started). It serves the
+                first item.
+
+        Yields:
+            The items of each generator, in order.
+        """
+        try:
+            async for item in items:
+                if held is None:
+                    await self.gate.acquire(reject=False)
+                try:
+                    async for output in self.iterate(fn(item), acquire=False):
+                        yield output
+                finally:
+                    if held is None:
+                        self.gate.release()
+                    else:
+                        held()
+                        held = None
+        finally:
+            if held is not None:
+                held()
+
+
+class SessionLocks:
+    """
+    Serializes the requests of each session, so concurrent turns of one
+    session do not interleave their history writes.
+
+    The locks only see the requests of this process. With several API
+    processes, pass a `lease` (see utils.repository.SessionLease) so the
+    turns of a session are also serialized across them.
+    """
+
+    def __init__(self, queue_depth: int, lease=None):
+        """
+        Args:
+            queue_depth (int): How many requests of a session may wait for
+                the one it is running, later ones are rejected.
+            lease: Serializes the sessions across processes, once the
+                in-process lock is taken.
+        """
+        self.queue_depth = queue_depth
+        self.lease = lease
+        # SessionId -> [lock, requests holding or waiting for it, lease token]
+        self._locks = {}
+
+    async def acquire(self, SessionId: str) -> None:
+        entry = self._locks.setdefault(SessionId, [asyncio.Lock(), 0, None])
+        if entry[1] > self.queue_depth:
+            raise SessionBusy(SessionId)
+        entry[1] += 1
+        start = time.perf_counter()
+        try:
+            await entry[0].acquire()
+            try:
+                if self.lease is not None:
+                    entry[2] = await self.lease.acquire(SessionId)
+            except BaseException:
+                entry[0].release()
+                raise
+        except BaseException:
+            self._leave(SessionId)
+            raise
+        finally:
+            record("session_queue", time.perf_counter() - start)
+
+    def release(self, SessionId: str) -> None:
+        entry = self._locks[SessionId]
+        if entry[2] is not None:
+            self.lease.release(SessionId, entry[2])
+            entry[2] = None
+        entry[0].release()
+        self._leave(SessionId)
+
+    def _leave(self, SessionId: str) -> None:
+        entry = self._locks[SessionId]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[SessionId]
+
+
+class Ticket:
+    """
+    The admission of one request: the session's turn and the gates it
+    holds, released together when the request (or its stream) is done.
+    """
+
+    def __init__(self, *releases):
+        """
+        Args:
+            releases: What to call on release, for what is already held.
+        """
+        self._releases = list(releases)
+        self.held = False
+
+    async def enter(self, gate: Gate) -> None:
+        """
+        Acquire one more gate for the rest of the request.
+        """
+        await gate.acquire()
+        self._releases.append(gate.release)
+
+    def leave(self, gate: Gate) -> None:
+        """
+        Release one gate before the rest of the request is done.
+        """
+        if gate.release in self._releases:
+            self._releases.remove(gate.release)
+            gate.release()
+
+    def release(self) -> None:
+        while self._releases:
+            self._releases.pop()()
+
+    def hold(self, iterable):
+        """
+        Keep the admission until a streamed response body is exhausted,
+        instead of releasing it when the endpoint returns.
+
+        Args:
+            iterable: The async response body.
+
+        Returns:
+            An async iterator over the body.
+        """
+        self.held = True
+        loop = asyncio.get_running_loop()
+
+        async def body():
+            try:
+                async for item in iterable:
+                    yield item
+            finally:
+                self.release()
+
+        def collected():
+            # the garbage collector may run on any thread, while the gates,
+            # session locks and lease renewal belong to the event loop
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self.release)
+
+        stream = body()
+        # released even when the client leaves before the stream starts
+        weakref.finalize(stream, collected)
+        return stream
+
+
+class Admission:
+    """
+    Admission control in front of the expensive endpoints.
+
+    Requests of one session run one at a time, and at most `gate.limit`
+    requests run at all, with bounded queues in front of both. The time
+    spent queueing is recorded in the request's stage breakdown.
+    """
+
+    def __init__(self, gate: Gate, sessions: SessionLocks):
+        self.gate = gate
+        self.sessions = sessions
+
+    @asynccontextmanager
+    async def admit(self, SessionId: str):
+        """
+        Wait for the session's turn and a free request slot.
+
+        Yields:
+            Ticket: The admission, released on exit unless a response body
+                holds it.
+        """
+        # the session's turn first, so queued requests of a busy session
+        # do not tie up request slots
+        await self.sessions.acquire(SessionId)
+        ticket = Ticket(lambda: self.sessions.release(SessionId))
+        try:
+            await ticket.enter(self.gate)
+            yield ticket
+        except BaseException:
+            ticket.release()
+            raise
+        if not ticket.held:
+            ticket.release()
+
+
+def session_lease():
+    """
+    The cross-process session lease, when SESSION_LEASES is on (needed with
+    several API processes, e.g. `uvicorn --workers`).
+    """
+    if os.getenv("SESSION_LEASES", "false").lower() != "true":
+        return None
+    from utils.repository import SessionLease
+
+    return SessionLease()
+
+
+# the caps are per API process: with several processes, divide them
+admission = Admission(
+    Gate(
+        "requests",
+        int(os.getenv("ADMISSION_MAX_REQUESTS", "16")),
+        int(os.getenv("ADMISSION_QUEUE", "32")),
+    ),
+    SessionLocks(int(os.getenv("SESSION_QUEUE", "1")), session_lease()),
+)
+# caps the chat calls sent to Ollama at once
+llm_gate = Gate.from_env("llm", limit=4, queue_depth=16)
+
+stages = {
+    "preprocess": StagePool.from_env("preprocess", workers=2),
+    # batched transcription needs as many concurrent callers as the batch
+    "stt": StagePool.from_env("stt", workers=int(os.getenv("STT_BATCH_SIZE", "1"))),
+    "tts": StagePool.from_env("tts"),
+}
@@ -92,27 +92,40 @@ export const ChatMode: React.FC = () => {
 
       if (updatedMessages.length === 6 && currentSessionData?.chat_name === 'New Chat') {
         console.log(`Fetching chat name for session: ${targetSessionId}`);
-        try {
-          const nameResponse = await fetch(`http://localhost:8000/get_chat_name/${targetSessionId}`, { // Added modelName
-            method: 'POST', // Assuming POST based on task description
-          });
-          if (!nameResponse.ok) {
-            throw new Error(`HTTP error! status: ${nameResponse.status}`);
+        // The name is generated in the background, poll for it without
+        // holding up the loading state of the chat
+        const pollChatName = async () => {
+          try {
+            const nameResponse = await fetch(`http://localhost:8000/get_chat_name/${targetSessionId}`, {
+              method: 'POST',
+            });
+            if (!nameResponse.ok) {
+              throw new Error(`HTTP error! status: ${nameResponse.status}`);
+            }
+            let nameData = await nameResponse.json();
+            for (let attempt = 0; nameData.status === 'pending' && attempt < 30; attempt++) {
+              await new Promise(resolve => setTimeout(resolve, 2000));
+              const pollResponse = await fetch(`http://localhost:8000/chat_name/${targetSessionId}`);
+              if (!pollResponse.ok) {
+                throw new Error(`HTTP error! status: ${pollResponse.status}`);
+              }
+              nameData = await pollResponse.json();
+            }
+            if (nameData.summarized_chat_name) {
+              console.log(`Updating chat name to: ${nameData.summarized_chat_name}`);
+              // Update the session name in the global state
+              const updatedSessions = useStore.getState().sessions.map(session =>
+                session.SessionId === targetSessionId
+                  ? { ...session, chat_name: nameData.summarized_chat_name }
+                  : session
+              );
+              setSessions(updatedSessions);
+            }
+          } catch (nameError) {
+            console.error('Failed to fetch or update chat name:', nameError);
           }
-          const nameData = await nameResponse.json();
-          if (nameData.summarized_chat_name) {
-            console.log(`Updating chat name to: ${nameData.summarized_chat_name}`);
-            // Update the session name in the global state
-            const updatedSessions = useStore.getState().sessions.map(session =>
-              session.SessionId === targetSessionId
-                ? { ...session, chat_name: nameData.summarized_chat_name }
-                : session
-            );
-            setSessions(updatedSessions);
-          }
-        } catch (nameError) {
-          console.error('Failed to fetch or update chat name:', nameError);
-        }
+        };
+        pollChatName();
       }
       // -------------------------------------------------
 